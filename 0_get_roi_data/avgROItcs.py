@@ -9,6 +9,7 @@ Get the betas for the main bounds vs perms analysis
 @notes:   Average ROIs across participants
 """
 import os
+import sys
 import time
 import pandas as pd
 import numpy as np
@@ -17,34 +18,43 @@ import matplotlib.pyplot as plt
 # Global locations
 rootdir = '/m/nbe/scratch/alex/private/jenni/eventseg'
 savedir = os.path.join(rootdir, 'fmri-data','ini-roi')
-roifile = 'tc_hoahc_concat.csv'
 df_subj = pd.read_csv(os.path.join(rootdir,'scripts','subj_info.csv'))
 
+sys.path.append(os.path.join(rootdir,'scripts','1_create_boundaries'))
+from evseg.roidata import load_roi, load_cohort, cohortfile
+
 #%% Average ROI tcs across participants
 
 tic = time.time()
 
-# Take first subject as base for summing
-subj = df_subj.subj[0]
-print(subj)
-roipath = os.path.join(savedir,subj,roifile)
-df_roi_sum = pd.read_csv(roipath, index_col=0)
+if os.path.isfile(os.path.join(savedir, cohortfile+'.npy')):
+    # Cohort binary: subjects x TR x ROI, memory-mapped
+    arr, subjs, cols, runind = load_cohort(savedir)
+    assert list(subjs) == list(df_subj.subj)
+    df_roi_avg = pd.DataFrame(arr.mean(axis=0, dtype=np.float64), columns=cols)
+    df_roi_avg['runind'] = runind
 
-# Loop thru the rest
-subjs = df_subj.subj[1:]
-for subj in subjs:
+else:
+    # Take first subject as base for summing
+    subj = df_subj.subj[0]
     print(subj)
-    roipath = os.path.join(savedir,subj,roifile)
-    df_roi = pd.read_csv(roipath, index_col=0)
-    df_roi_sum = df_roi_sum + df_roi
+    df_roi_sum = load_roi(os.path.join(savedir,subj)).astype(np.float64)
+
+    # Loop thru the rest
+    subjs = df_subj.subj[1:]
+    for subj in subjs:
+        print(subj)
+        df_roi = load_roi(os.path.join(savedir,subj))
+        df_roi_sum = df_roi_sum + df_roi
+
+    df_roi_avg = df_roi_sum / len(df_subj)
 
-df_roi_avg = df_roi_sum / len(df_subj)
 toc = time.time()
 print(toc-tic)
 
 #%% Sanity checks
 
-areas = df_roi.columns
+areas = df_roi_avg.columns
 plt.plot(df_roi_avg[areas[48]]) # HC
 plt.plot(df_roi_avg[areas[29]]) # PCC
 plt.plot(df_roi_avg[areas[30]]) # precuneus
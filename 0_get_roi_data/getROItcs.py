@@ -3,6 +3,10 @@
 """
 EVENT SEGMENTATION
 Getting ROI time courses from ini-data
+Usage: python getROItcs.py [<order> <scale>]
+    Detrend order per run (-1 for none) and scaling (zscore, psc or none),
+    default 1 zscore. The raw ROI means are kept (tc_hoahc_raw), so a rerun
+    with other cleaning does not read the NIfTIs again.
 
 @author:  jenni.saaristo@helsinki.fi
 @version: 2021-07-01
@@ -11,26 +15,38 @@ Getting ROI time courses from ini-data
 """
 
 import os
+from sys import argv
 import sys
 import time
 from joblib import Parallel, delayed
 from nilearn import datasets
-from nilearn.input_data import NiftiLabelsMasker
-import numpy as np
+import nibabel as nib
 import pandas as pd
 
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.roidata import save_roi, load_roi, save_cohort, rawfile
+from evseg.roiextract import cached_label_index, extract_runs, clean_tcs
+
 # Global locations
 rootdir = '/m/nbe/scratch/alex/private/jenni/eventseg'
 savedir = os.path.join(rootdir, 'fmri-data','ini-roi')
 maskdir = os.path.join(rootdir,'masks')
 inidir = '/m/nbe/scratch/alex/private/maria/alex/ini-data'
 nii = '_mni152_maxCorr10_LP4Hz_smoothed6_tsm2.nii'
+block = 50 # volumes read at a time, sets the memory per worker (~ block x 7 MB at 2 mm)
+runs = list(range(2,12)) # story is in runs 2–11
+
+def iniFiles(subj):
+    return [os.path.join(inidir, subj, 'run'+str(run), 'acc' + str(run) + nii)
+            for run in runs]
 
 # =============================================================================
 #
 # =============================================================================
 
-def getROItcs(subj):
+def getROItcs(subj, labelimgs, cols, order=1, scale='zscore'):
 
     tic = time.time() # Start
 
@@ -43,58 +59,42 @@ def getROItcs(subj):
     joblog.write('PID: '+ str(os.getpid()) + '\n')
 
     try:
-        # We need to redirect stdout to log nilearn output
-        origout = sys.stdout
-        sys.stdout = joblog
-
-        # Get masks
-        combhip = os.path.join(maskdir,'hipp_thr25_2mm.nii')
-        hcmasker = NiftiLabelsMasker(labels_img=combhip, standardize='zscore',
-                               detrend=True, memory='nilearn_cache', verbose=5)
-        hoa = datasets.fetch_atlas_harvard_oxford('cort-maxprob-thr25-2mm', maskdir)
-        hoamasker = NiftiLabelsMasker(labels_img=hoa.maps, standardize='zscore',
-                               detrend=True, memory='nilearn_cache', verbose=5)
-
-        # Get the data
-        runs = list(range(2,12)) # story is in runs 2–11
-        tcs = np.empty((0,50))
-
-        joblog.write('Extracting ROIs...')
-        for i in range(10):
-
-            # make ini filename
-            run = runs[i]
-            fname = 'acc' + str(run) + nii
-            inifile = os.path.join(inidir, subj, 'run'+str(run), fname)
-
-            # get timecourses for hoa ROIs + hc
-            hoa_tc = hoamasker.fit_transform(inifile)
-            hc_tc = hcmasker.fit_transform(inifile)
-            runind = np.ones(hc_tc.shape)*i
-
-            # hstack all ROIs
-            tc = np.hstack((hoa_tc,hc_tc,runind))
-            # vstack to previous runs
-            tcs = np.vstack((tcs,tc))
-
-        sys.stdout = origout
-
-        # Create data frame
-        cols = hoa.labels[1:]
-        cols.extend(['Hippocampus', 'runind'])
-        df_roi = pd.DataFrame(data=tcs, columns=cols)
-        df_roi['runind'] = df_roi['runind'].astype(int)
-
-        # Save data
+        # Raw ROI means, extracted only once (remove the raw file to redo,
+        # e.g. with new atlases)
+        if os.path.isfile(os.path.join(savepath, rawfile+'.npy')):
+            df_raw = load_roi(savepath, rawfile)
+            joblog.write('Loaded raw ROI means from '+ savepath + '\n')
+        else:
+            inifiles = iniFiles(subj)
+
+            # HOA ROIs + hc as one label index, so each run is read only once
+            # (cached in maskdir for the grid of the data)
+            vox, starts, labels = cached_label_index(labelimgs, nib.load(inifiles[0]), maskdir)
+            if len(labels) != len(cols):
+                raise ValueError(f'Got {len(labels)} ROIs for {len(cols)} labels.')
+
+            joblog.write('Extracting ROIs...\n')
+            tcs, runind = extract_runs(inifiles, vox, starts, block=block)
+            df_raw = pd.DataFrame(data=tcs, columns=cols)
+            df_raw['runind'] = runind
+            save_roi(df_raw, savepath, rawfile, dtype='float64')
+
+        # Clean: detrend & scale each run
+        joblog.write(f'Cleaning: detrend order {order}, scaling {scale}\n')
+        df_roi = pd.DataFrame(clean_tcs(df_raw[cols], df_raw['runind'], order, scale),
+                              columns=cols)
+        df_roi['runind'] = df_raw['runind'].to_numpy()
+
+        # Save data (CSV and the binary copy the drivers load)
         df_roi.to_csv(os.path.join(savepath,'tc_hoahc_concat.csv'))
+        save_roi(df_roi, savepath)
 
-        joblog.write(f"Done. TRs extracted: {str(len(tcs))}\n\n")
+        joblog.write(f"Done. TRs extracted: {str(len(df_roi))}\n\n")
         toc = time.time() # End
         joblog.write('Ended: '+ time.asctime(time.localtime(toc)) + '\n')
         joblog.close()
 
     except Exception as e:
-        sys.stdout = origout
         toc = time.time() # End
         joblog.write('Error occured:' + time.asctime(time.localtime(toc)) + '\n')
         print(e, file=joblog)
@@ -107,17 +107,41 @@ def getROItcs(subj):
 
 if __name__ == '__main__':
 
+    # Cleaning (e.g. 2 psc); reruns only redo this from the raw means
+    assert len(argv) in (1,3)
+    order = int(argv[1]) if len(argv) == 3 else 1 # detrend order (-1 for none)
+    scale = argv[2] if len(argv) == 3 else 'zscore' # zscore, psc or none
+    order = None if order < 0 else order
+    scale = None if scale == 'none' else scale
+
     # Get subjects
     df_subj = pd.read_csv(os.path.join(rootdir,'scripts','subj_info.csv'))
     subjs = df_subj.subj
 
+    # Get masks (HOA ROIs + hc)
+    combhip = os.path.join(maskdir,'hipp_thr25_2mm.nii')
+    hoa = datasets.fetch_atlas_harvard_oxford('cort-maxprob-thr25-2mm', maskdir)
+    labelimgs = [hoa.maps, combhip]
+    cols = hoa.labels[1:] + ['Hippocampus']
+
+    # Label index for each grid there is, before the jobs start
+    for subj in subjs:
+        if not os.path.isfile(os.path.join(savedir, subj, rawfile+'.npy')):
+            cached_label_index(labelimgs, nib.load(iniFiles(subj)[0]), maskdir)
+
     # Iterate subjects
     print('Starting parallel jobs...')
-    res = Parallel(n_jobs=10) (delayed(getROItcs) (subj) for subj in subjs)
+    res = Parallel(n_jobs=10) (delayed(getROItcs) (subj,labelimgs,cols,order,scale) for subj in subjs)
 
     df = pd.DataFrame()
     df['subj'] = subjs
     df['fail'] = res
 
     print(df)
+
+    # Stack all subjects into one binary (e.g. for averaging)
+    if not any(res):
+        save_cohort(savedir, subjs)
+        print('Saved cohort file.')
+
     print('All done.')
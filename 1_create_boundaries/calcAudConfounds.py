@@ -13,11 +13,14 @@ from os.path import join
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from evseg import audio, epochs, timeline
 
 audiodir = '/m/nbe/scratch/alex/stimuli/wav/concatenated_story'
 datadir = '/m/nbe/scratch/alex/private/jenni/eventseg/scripts/1_create_boundaries/out'
 
 boundfile = 'boundaries_f1s.csv'
+bankfile = 'audiofeatures.npy' # feature bank from makeAudioEnvelopes
+permfile = 'perms_meg_1s.npy'   # perms in audio concat time (makePermuted)
 
 #%% Get dfs
 df_bounds = pd.read_csv(join(datadir,boundfile), index_col=0)
@@ -25,11 +28,12 @@ df_gaps = pd.read_csv(join(datadir,'all_audiogaps_f.csv'), index_col=0)
 df_parts = pd.read_csv(join(datadir,'partlensf.csv'), index_col=0)
 parts = df_parts.part.unique()
 
-#%% Read envelopes
+#%% Read envelopes from the feature bank
 d = 10 # srate in Hz
+bank = audio.load_bank(join(audiodir, bankfile))
 envs = {}
 for p in parts:
-    envs[p] = np.load(join(audiodir, f'kappale{p}_envelope_{d}Hz.npy'))
+    envs[p] = audio.query_bank(bank, p, d, features='env')
 
 #%% Plot to check
 fig, axs = plt.subplots(5,2,sharey=True)
@@ -44,31 +48,41 @@ max_all = max([max(e) for e in envs.values()])
 for p in parts:
     envs[p] /= max_all
 
-#%% Calc meanvol
+#%% Calc meanvol and voldiff for several windows
+# Epochs are edge-padded at the chapter ends, and all sets go in one call
+wins = [1, 2, 4] # window lengths (sec)
 
-win = 1 * d # window (sec) * Hz of env
-half = int(win/2)
+def vol_table(parts, t):
+    meanvol, voldiff = epochs.vol_confounds(envs, parts, t, wins, d)
+    cols = {}
+    for (j,w) in enumerate(wins):
+        cols[f'meanvol_{w}s'] = meanvol[...,j]
+        cols[f'voldiff_{w}s'] = voldiff[...,j]
+    return cols
 
-for p in parts:
-    inds = df_bounds.query('part == @p').index
-    rts = df_bounds.loc[inds, 'rt'].to_numpy() * d
-    rts = rts.astype(int)
-    
-    # Gather epochs with len=win around rts (symmetric)
-    epochs = np.zeros((len(rts),win))
-    for i in range(len(rts)):
-        epochs[i,:] = envs[p][ rts[i]-half : rts[i]+half ]
-    
-    # Calculate mean vol and vol difference (where > 0 means increasing vol)
-    meanvol = epochs.mean(axis=-1)
-    voldiff = epochs[:,half+1:].mean(axis=-1) - epochs[:,:half+1].mean(axis=-1)
-    
-    # Copy to df
-    df_bounds.loc[inds,'meanvol'] = meanvol
-    df_bounds.loc[inds,'voldiff'] = voldiff
+# Boundaries (the 1 s window also as plain meanvol/voldiff, as before)
+for (c,v) in vol_table(df_bounds['part'], df_bounds['rt']).items():
+    df_bounds[c] = v
+df_bounds['meanvol'] = df_bounds['meanvol_1s']
+df_bounds['voldiff'] = df_bounds['voldiff_1s']
+
+# All audio gaps, at the gap offset (audio time)
+for (c,v) in vol_table(df_gaps['part'], df_gaps['audio_off']).items():
+    df_gaps[c] = v
+
+# All permutation sets at once (bounds x perms), in long format; perms are
+# numbered from 1 as in the beta tables (0 = the intact bounds)
+perms = np.load(join(datadir, permfile))
+pparts, pt = timeline.to_part(perms, df_parts)
+df_permvol = pd.DataFrame({'perm': np.tile(np.arange(perms.shape[1]) + 1, len(perms)),
+                           'part': pparts.ravel(), 'rt': pt.ravel()})
+for (c,v) in vol_table(pparts, pt).items():
+    df_permvol[c] = v.ravel()
 
 #%% Save
 df_bounds.to_csv(join(datadir, 'boundaries_f1s_vol.csv'))
+df_gaps.to_csv(join(datadir, 'all_audiogaps_f_vol.csv'))
+df_permvol.to_csv(join(datadir, 'perms_1s_vol.csv'))
 
 #%% Some checks
 p = 3
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION
+Check parameters for combining the boundaries
+
+@notes:   sweep of react_time x br1 x br2 x th for makeBoundaries
+"""
+
+import os
+import pandas as pd
+import numpy as np
+from evseg import sweep
+import matplotlib.pyplot as plt
+
+datadir = '/Users/jenska/code/python/eventsegment/segment_data/behavioral_ratings_data/flat'
+outdir = '/Users/jenska/code/python/eventcode/1_create_boundaries/out'
+datafile = 'segment_data_full.csv'
+
+#%% Get data
+df = pd.read_csv(os.path.join(datadir,datafile),index_col=0)
+df_parts = pd.read_csv(os.path.join(outdir,'partlensf.csv'),index_col=0)
+
+#%% Define the grid
+react_times = [0, 1, 2, 3, 4]
+br1s = np.arange(1, 3.1, 0.5)
+br2s = np.arange(2, 6.1, 1)
+ths = list(range(1,9))
+
+#%% Run the sweep (in parallel, all cores)
+df_sweep = sweep.sweep_params(df, df_parts, react_times, br1s, br2s, ths)
+print(df_sweep)
+
+#%% Save
+df_sweep.to_csv(os.path.join(outdir,'checkParams.csv'))
+
+#%% Look at the chosen ones: how do the numbers change with threshold
+these = df_sweep.query('react_time == 3 & win1 == 1.5 & win2 == 4')
+print(these)
+
+fig, axs = plt.subplots(ncols=2, figsize=(10,4), constrained_layout=True)
+axs[0].plot(these['th'], these['nbounds'], 'o-')
+axs[0].set_xlabel('th')
+axs[0].set_ylabel('boundaries')
+axs[1].plot(these['th'], these['seg_mean'], 'o-', label='segment')
+axs[1].plot(these['th'], these['clen_mean'], 'o-', label='cluster')
+axs[1].set_xlabel('th')
+axs[1].set_ylabel('mean length (sec)')
+axs[1].legend()
+plt.show()
@@ -12,7 +12,7 @@ from os.path import join
 import pandas as pd
 import numpy as np
 import scipy.io.wavfile
-import eventseg as es
+from evseg import timeline
 import matplotlib.pyplot as plt
 
 datadir = '/Users/jenska/code/python/eventsegment/segment_data/behavioral_ratings_data/flat'
@@ -28,11 +28,7 @@ df_parts = pd.read_csv(join(datadir,'partlens.csv'),index_col=0)
 #%% Make concat rt
 for df in [df_orig, df_mod]:
     df.rename(columns={'Unnamed: 0':'id'}, inplace=True)
-    df['rt_concat'] = 0
-    for i in df_parts.index:
-        p = df_parts.part[i]
-        ind = df.query('part == @p').index
-        df.loc[ind, 'rt_concat'] = df.loc[ind, 'rt'] + df_parts.start[i]
+    df['rt_concat'] = timeline.to_concat(df['rt'], df['part'], df_parts)
 
 #%% We'll manually correct the extra boundaries before calculating stats
 # The corected go into a dict
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Averaging betas over subjects, all subject subsets in one pass
+
+Each subject file is read once, and its betas are streamed into running
+mean/variance accumulators (Welford) of every subset the subject belongs to,
+one value per group (e.g. area x perm). Replaces stacking all subjects into
+one long frame and querying it once per group and subset.
+
+@notes:   used by all 4_get_averages scripts
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from .results import ResultBuffer
+
+
+class GroupedStats:
+    """
+    Running mean and SEM of a value per group, for several subsets
+
+    Parameters
+    ----------
+    groups : DataFrame
+        The groups, one row each, columns being the grouping keys. Output
+        rows come in this order.
+    subsets : list of str
+        Names of the subsets (e.g. 'all', '1st', '2nd').
+
+    """
+
+    def __init__(self, groups, subsets):
+        self.groups = groups.reset_index(drop=True)
+        self.index = pd.MultiIndex.from_frame(self.groups)
+        shape = (len(subsets), len(self.groups))
+        self.subsets = list(subsets)
+        self.n = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, df, subsets, value='beta'):
+        """
+        Add the values of one subject to the given subsets
+
+        Parameters
+        ----------
+        df : DataFrame
+            Rows of the subject, with the grouping keys and the value.
+            Each group should appear at most once.
+        subsets : list of str
+            The subsets the subject belongs to.
+        value : str, optional
+            Column to average. The default is 'beta'.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        rows = self.index.get_indexer(pd.MultiIndex.from_frame(df[self.groups.columns]))
+        if (rows < 0).any():
+            raise KeyError('Rows with groups not in the template.')
+        x = df[value].to_numpy(dtype=float)
+        ok = ~np.isnan(x)       # nans are skipped, as in Series.mean/std
+        rows, x = rows[ok], x[ok]
+
+        for s in subsets:
+            i = self.subsets.index(s)
+            n = self.n[i, rows] + 1
+            delta = x - self.mean[i, rows]
+            self.mean[i, rows] += delta / n
+            self.m2[i, rows] += delta * (x - self.mean[i, rows])
+            self.n[i, rows] = n
+
+    def to_frame(self, subset, value='beta'):
+        """
+        Mean and SEM (std with ddof=1 / sqrt(n)) of each group
+
+        Parameters
+        ----------
+        subset : str
+            The subset.
+        value : str, optional
+            Name of the mean column. The default is 'beta'.
+
+        Returns
+        -------
+        df_avg : DataFrame
+            The grouping keys, value and 'se'.
+
+        """
+
+        i = self.subsets.index(subset)
+        n = self.n[i]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, self.mean[i], np.nan)
+            se = np.sqrt(self.m2[i] / (n-1)) / np.sqrt(n)
+
+        df_avg = self.groups.copy()
+        df_avg[value] = mean
+        df_avg['se'] = np.where(n > 1, se, np.nan)
+
+        return df_avg
+
+
+def average_subjects(files, by, subsets, value='beta', keep=None, read=None):
+    """
+    Read each subject once and average over all subsets at the same time
+
+    Parameters
+    ----------
+    files : dict
+        Beta file (CSV) of each subject, or whatever read takes.
+    by : list of str
+        Grouping keys, outermost first; groups are ordered as nested loops
+        over their unique values (in order of appearance).
+    subsets : dict
+        Subjects of each subset.
+    value : str, optional
+        Column to average. The default is 'beta'.
+    keep : bool or str, optional
+        Rows to collect into a long frame (with 'subj'): True for all, or a
+        query string. The default is None (no long frame).
+    read : callable, optional
+        Reads the betas of a subject given its files entry, e.g. from the
+        Parquet store. The default is reading the CSV.
+
+    Returns
+    -------
+    avgs : dict
+        Averages (keys, value, 'se') of each subset.
+    df_long : DataFrame or None
+        The kept rows of all subjects.
+
+    """
+
+    if read is None:
+        read = lambda path: pd.read_csv(path, index_col=0)
+
+    members = {k: set(subjs) for (k,subjs) in subsets.items()}
+    stats, buf = None, None
+    for (s,path) in files.items():
+        df_this = read(path)
+
+        if stats is None:
+            groups = pd.MultiIndex.from_product([df_this[k].unique() for k in by],
+                                                names=by).to_frame(index=False)
+            stats = GroupedStats(groups, subsets)
+        stats.add(df_this, [k for (k,m) in members.items() if s in m], value)
+
+        if keep is not None and keep is not False:
+            df_keep = df_this if keep is True else df_this.query(keep)
+            if buf is None:
+                buf = ResultBuffer.like(df_keep, len(df_keep)*len(files), subj=object)
+            buf.add_frame(df_keep, subj=s)
+
+    avgs = {k: stats.to_frame(k, value) for k in subsets}
+    df_long = None if buf is None else buf.to_frame()
+
+    return avgs, df_long
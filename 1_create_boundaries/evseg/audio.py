@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Streaming envelope extraction and the audio feature bank
+
+Same output as abs(hilbert(audio)) decimated with decimate(..., ftype='fir'),
+but in constant memory: the WAV is memory-mapped and walked through in blocks.
+For each block the analytic signal is computed by overlap-save with a long
+Kaiser-windowed FIR Hilbert transformer (one FFT convolution of the block plus
+its halo, wrapped part discarded), and the envelope is decimated with
+decimate's own FIR filter as a polyphase filter (upfirdn), evaluated only at
+the kept samples.
+
+The FIR Hilbert differs from the full-length FFT one only below a few tens of
+Hz (the transition band), and at the very edges of the chapter.
+
+The feature bank runs the same pass once per chapter for several features
+(broadband envelope, band-limited envelopes, RMS and RMS level in dB) and several
+output rates (e.g. 10 Hz and TR-rate), and stores everything in one binary
+(see binstore): rows are samples, stacked rate by rate and part by part,
+columns are features, and the JSON index tells where each (rate, part) block
+starts. query_bank cuts out a part and time range.
+
+@notes:   replaces the whole-file hilbert of makeAudioEnvelopes
+
+"""
+
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import firwin, fftconvolve, upfirdn
+
+from .binstore import save_binary, load_binary
+
+
+def read_wav(path):
+    """ Memory-mapped WAV (multichannel is averaged blockwise later) """
+    srate, audio = wavfile.read(path, mmap=True)
+    return srate, audio
+
+
+def hilbert_fir(numtaps, beta=8.):
+    """
+    Kaiser-windowed FIR Hilbert transformer (type III, odd numtaps)
+
+    Parameters
+    ----------
+    numtaps : int
+        Length of the filter, made odd if even.
+    beta : float, optional
+        Kaiser window parameter. The default is 8.
+
+    Returns
+    -------
+    h : ndarray
+        The filter, centered at numtaps // 2.
+
+    """
+
+    half = numtaps // 2
+    n = np.arange(-half, half+1)
+    h = np.zeros(len(n))
+    odd = n % 2 == 1
+    h[odd] = 2 / (np.pi * n[odd])
+
+    return h * np.kaiser(len(n), beta)
+
+
+def decimate_fir(q):
+    """ The FIR filter scipy's decimate(..., ftype='fir') uses """
+    half_len = 10 * q
+    return firwin(2*half_len+1, 1. / q, window='hamming')
+
+
+def analytic_kernels(srate, bands=(), hilbert_sec=0.4, band_sec=0.05):
+    """
+    Complex FIR kernels giving the analytic signal, broadband and per band
+
+    Parameters
+    ----------
+    srate : int
+        Sampling rate of the audio.
+    bands : list of (float, float), optional
+        Pass bands (Hz) of the band-limited envelopes. The default is none.
+    hilbert_sec : float, optional
+        Length of the FIR Hilbert transformer (sec). The default is 0.4.
+    band_sec : float, optional
+        Length of the band-pass filters (sec). The default is 0.05.
+
+    Returns
+    -------
+    kernels : ndarray
+        Taps x (1 + len(bands)), all centered at taps // 2.
+
+    """
+
+    h = hilbert_fir(int(hilbert_sec*srate) | 1)
+    half = len(h) // 2
+    delta = np.zeros(len(h))
+    delta[half] = 1
+    kernels = [delta + 1j*h]
+
+    # band-pass followed by Hilbert, as one kernel
+    for (lo,hi) in bands:
+        bp = firwin(int(band_sec*srate) | 1, [lo, hi], pass_zero=False, fs=srate)
+        kernels.append(np.convolve(bp, delta + 1j*h))
+
+    taps = max(len(k) for k in kernels)
+    out = np.zeros((taps, len(kernels)), dtype=complex)
+    for (i,k) in enumerate(kernels):
+        pad = (taps - len(k)) // 2
+        out[pad:pad+len(k), i] = k
+
+    return out
+
+
+def _segment(audio, start, stop):
+    """ audio[start:stop] as float, zero-padded outside the file """
+    n = len(audio)
+    seg = np.zeros(stop - start)
+    a, b = max(start, 0), min(stop, n)
+    if a < b:
+        x = np.asarray(audio[a:b], dtype=np.float64)
+        seg[a-start:b-start] = x.mean(axis=1) if x.ndim > 1 else x
+    return seg
+
+
+def feature_block(audio, start, stop, kernels, power=False):
+    """
+    Full-rate features of samples start..stop-1 (zero outside the file)
+
+    Parameters
+    ----------
+    audio : ndarray
+        The (memory-mapped) audio.
+    start : int
+        First sample.
+    stop : int
+        One past the last sample.
+    kernels : ndarray
+        Analytic kernels (from analytic_kernels), taps x K.
+    power : bool, optional
+        Add the squared signal as the last column. The default is False.
+
+    Returns
+    -------
+    feats : ndarray
+        Envelopes (and power), (stop - start) x (K + power).
+
+    """
+
+    half = len(kernels) // 2
+    seg = _segment(audio, start-half, stop+half)
+
+    # overlap-save: 'valid' keeps only the samples with a full halo
+    feats = np.abs(fftconvolve(seg[:,np.newaxis], kernels, mode='valid', axes=0))
+    if power:
+        feats = np.column_stack([feats, seg[half:len(seg)-half]**2])
+
+    # decimate zero-pads the envelope, not the audio
+    feats[:max(0, -start)] = 0
+    feats[max(0, len(audio)-start):] = 0
+
+    return feats
+
+
+def stream_features(audio, srate, rates, kernels, power=False, block=60):
+    """
+    Features decimated to several rates, in one blockwise pass
+
+    Each output sample k of a rate (decimation factor q) is centered at audio
+    sample k*q, and all outputs centered within the current block are made
+    from one full-rate feature block that covers the widest filter halo.
+
+    Parameters
+    ----------
+    audio : ndarray
+        The (memory-mapped) audio.
+    srate : int
+        Sampling rate of the audio.
+    rates : list of float
+        Output rates (Hz).
+    kernels : ndarray
+        Analytic kernels (from analytic_kernels).
+    power : bool, optional
+        Also decimate the squared signal (last column). The default is False.
+    block : float, optional
+        Block length (sec); sets the peak memory, roughly
+        (block + 20 / min(rates)) * srate * (K + power) floats. The default is 60.
+
+    Returns
+    -------
+    outs : list of ndarray
+        One array per rate, samples x (K + power).
+
+    """
+
+    n = len(audio)
+    qs = [round(srate/r) for r in rates]
+    filts = [decimate_fir(q) for q in qs]
+    halo = max(len(b) // 2 for b in filts)
+    nfeat = kernels.shape[1] + power
+
+    outs = [np.empty((-(-n // q), nfeat)) for q in qs]
+    N = max(1, int(block*srate))
+    for A in range(0, n, N):
+        feats = feature_block(audio, A-halo, min(A+N, n)+halo, kernels, power)
+
+        for (q,b,out) in zip(qs, filts, outs):
+            k0, k1 = -(-A // q), min(-(-(A+N) // q), len(out))
+            if k0 >= k1:
+                continue
+
+            # polyphase decimation: y[k] = sum_j b[j] f[k*q + half_len - j]
+            half_len = len(b) // 2
+            r = (2*half_len) % q
+            skip = (2*half_len - r) // q
+            sub = feats[k0*q - half_len - (A-halo) : (k1-1)*q + half_len + 1 - (A-halo)]
+            out[k0:k1] = upfirdn(b, sub[r:], 1, q, axis=0)[skip:skip + k1-k0]
+
+    return outs
+
+
+def envelope(path, d=10, block=60, hilbert_sec=0.4):
+    """
+    Broadband envelope of a WAV at d Hz, in constant memory
+
+    Parameters
+    ----------
+    path : str
+        The WAV file.
+    d : int, optional
+        Output sampling rate (Hz). The default is 10.
+    block : float, optional
+        Block length (sec); sets the peak memory. The default is 60.
+    hilbert_sec : float, optional
+        Length of the FIR Hilbert transformer (sec). The default is 0.4.
+
+    Returns
+    -------
+    denv : ndarray
+        The envelope, len(audio) / (srate/d) samples rounded up.
+
+    """
+
+    srate, audio = read_wav(path)
+    kernels = analytic_kernels(srate, hilbert_sec=hilbert_sec)
+    denv, = stream_features(audio, srate, [d], kernels, block=block)
+
+    return denv[:,0]
+
+
+def feature_bank(path, rates=(10, 1), bands=(), block=60, hilbert_sec=0.4):
+    """
+    All features of a WAV at all rates, in one pass
+
+    Parameters
+    ----------
+    path : str
+        The WAV file.
+    rates : list of float, optional
+        Output rates (Hz). The default is 10 Hz and 1 Hz (TR-rate).
+    bands : list of (float, float), optional
+        Pass bands (Hz) of the band-limited envelopes. The default is none.
+    block : float, optional
+        Block length (sec); sets the peak memory. The default is 60.
+    hilbert_sec : float, optional
+        Length of the FIR Hilbert transformer (sec). The default is 0.4.
+
+    Returns
+    -------
+    outs : list of ndarray
+        One array per rate, samples x features.
+    features : list of str
+        'env', 'env_{lo}_{hi}' per band, 'rms' and 'rms_db' (RMS level, dB re
+        1 in the units of the WAV; not a loudness model).
+
+    """
+
+    srate, audio = read_wav(path)
+    kernels = analytic_kernels(srate, bands, hilbert_sec=hilbert_sec)
+    outs = stream_features(audio, srate, rates, kernels, power=True, block=block)
+
+    # low-passed power to RMS and RMS level (dB)
+    for (i,out) in enumerate(outs):
+        ms = np.clip(out[:,-1], 0, None)
+        outs[i] = np.column_stack([out[:,:-1], np.sqrt(ms),
+                                   10*np.log10(np.maximum(ms, 1e-12))])
+
+    features = ['env'] + [f'env_{lo:g}_{hi:g}' for (lo,hi) in bands] + ['rms', 'rms_db']
+
+    return outs, features
+
+
+def save_bank(wavs, path, rates=(10, 1), bands=(), **kwargs):
+    """
+    Make the feature bank of all parts and save it as one binary
+
+    Parameters
+    ----------
+    wavs : dict
+        WAV path of each part.
+    path : str
+        Path of the .npy file (the .json index gets the same stem).
+    rates : list of float, optional
+        Output rates (Hz). The default is 10 Hz and 1 Hz (TR-rate).
+    bands : list of (float, float), optional
+        Pass bands (Hz) of the band-limited envelopes. The default is none.
+    **kwargs : optional
+        Passed to feature_bank (block, hilbert_sec).
+
+    Returns
+    -------
+    None.
+
+    """
+
+    res = {p: feature_bank(wav, rates, bands, **kwargs) for (p,wav) in wavs.items()}
+    features = next(iter(res.values()))[1]
+
+    arrs, blocks, row = [], [], 0
+    for (i,rate) in enumerate(rates):
+        for p in wavs:
+            arr = res[p][0][i]
+            blocks.append([float(rate), int(p), row, len(arr)])
+            arrs.append(arr)
+            row += len(arr)
+
+    save_binary(np.concatenate(arrs), path, columns=features,
+                rates=[float(r) for r in rates], blocks=blocks)
+
+
+def load_bank(path, mmap_mode='r'):
+    """ The feature bank as (arr, index), see query_bank """
+    return load_binary(path, mmap_mode=mmap_mode)
+
+
+def query_bank(bank, part, rate, start=None, stop=None, features='env'):
+    """
+    Cut a part and time range out of the feature bank
+
+    Parameters
+    ----------
+    bank : tuple
+        (arr, index) from load_bank.
+    part : int
+        The part.
+    rate : float
+        The rate (Hz), one of those in the bank.
+    start : float, optional
+        Start time (sec, part time), inclusive. The default is the beginning.
+    stop : float, optional
+        Stop time (sec, part time), exclusive. The default is the end.
+    features : str or list of str, optional
+        The feature(s). The default is 'env'.
+
+    Returns
+    -------
+    x : ndarray
+        Samples k with start <= k/rate < stop (1-D for one feature, else
+        samples x features).
+
+    """
+
+    arr, index = bank
+    rows = {(r, p): (row, n) for (r, p, row, n) in index['blocks']}
+    if (float(rate), int(part)) not in rows:
+        raise KeyError(f'No part {part} at {rate} Hz in the feature bank.')
+    row, n = rows[(float(rate), int(part))]
+
+    # sample indices of the range (rounded to avoid float noise in t*rate)
+    k0 = 0 if start is None else int(np.ceil(round(start*rate, 9)))
+    k1 = n if stop is None else int(np.ceil(round(stop*rate, 9)))
+    k0, k1 = min(max(k0, 0), n), min(max(k1, 0), n)
+
+    cols = index['columns']
+    if isinstance(features, str):
+        return np.array(arr[row+k0:row+k1, cols.index(features)])
+    return np.asarray(arr[row+k0:row+k1][:, [cols.index(f) for f in features]])
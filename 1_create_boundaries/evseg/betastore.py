@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Parquet store for betas (per subject, long files and averages)
+
+All betas of one kind go into one Parquet dataset, hive-partitioned as
+
+    root/analysis=<name>/subj=<subj>/area=<area>/*.parquet
+
+(subj only when the table has one), with typed columns. Readers can then
+ask for just the columns and partitions they need, e.g. one area of one
+analysis, or perm == 0 only (predicate pushdown); the same layout opens in
+R with arrow::open_dataset(root). CSV stays as the export format.
+
+Needs pyarrow.
+
+@notes:   used by the get* drivers and the 4_get_averages scripts
+
+"""
+
+import os
+import pandas as pd
+
+from .checkpoint import atomic_write
+
+outfmts = ('csv', 'parquet', 'both')
+betastore = 'betas.parquet'     # dataset directory, in savedir / outdir
+
+
+def analysis_name(filename):
+    """ Analysis name of an output file, i.e. its stem """
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _typed(df):
+    """ Numeric columns as numbers, the rest as strings """
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == object:
+            num = pd.to_numeric(df[c], errors='coerce')
+            df[c] = num if num.notna().all() else df[c].astype(str)
+    return df
+
+
+def save_betas(df, root, analysis, subj=None):
+    """
+    Write a table of betas into the dataset, replacing its partitions
+
+    Parameters
+    ----------
+    df : DataFrame
+        The betas (e.g. perm, beta, se, p, area). A 'subj' column, or the
+        subj argument, adds the subject partition level.
+    root : str
+        Dataset directory.
+    analysis : str
+        Analysis name (e.g. 'betas_boundperm_3s').
+    subj : str, optional
+        Subject of all rows. The default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    df = _typed(df)
+    df.insert(0, 'analysis', analysis)
+    if subj is not None:
+        df.insert(1, 'subj', subj)
+
+    parts = [c for c in ['analysis', 'subj', 'area'] if c in df.columns]
+    df.to_parquet(root, engine='pyarrow', index=False, partition_cols=parts,
+                  existing_data_behavior='delete_matching')
+
+
+def read_betas(root, analysis, subjs=None, areas=None, columns=None, filters=None):
+    """
+    Read betas of one analysis, only the partitions and columns asked for
+
+    Parameters
+    ----------
+    root : str
+        Dataset directory.
+    analysis : str
+        Analysis name.
+    subjs : list of str, optional
+        Subjects to read. The default is all.
+    areas : list of str, optional
+        Areas to read. The default is all.
+    columns : list of str, optional
+        Columns to read (partition columns included). The default is all.
+    filters : list of tuple, optional
+        More pyarrow filters, e.g. [('perm', '==', 0)]. The default is none.
+
+    Returns
+    -------
+    df : DataFrame
+        The betas, partition columns as plain strings.
+
+    """
+
+    flt = [('analysis', '==', analysis)]
+    if subjs is not None:
+        flt.append(('subj', 'in', [str(s) for s in subjs]))
+    if areas is not None:
+        flt.append(('area', 'in', [str(a) for a in areas]))
+    flt += list(filters or [])
+
+    df = pd.read_parquet(root, engine='pyarrow', columns=columns, filters=flt)
+
+    # (levels other analyses of the dataset have but this one has not are null)
+    for c in ['analysis', 'subj', 'area']:
+        if c in df.columns:
+            df[c] = df[c].astype(object)
+            if df[c].isna().all():
+                df = df.drop(columns=c)
+            else:
+                df[c] = df[c].astype(str)
+
+    return df.drop(columns='analysis', errors='ignore')
+
+
+def write_output(df, path, outfmt='csv', root=None, subj=None):
+    """
+    Save an output table as CSV, into the Parquet store, or both
+
+    Parameters
+    ----------
+    df : DataFrame
+        The table.
+    path : str
+        CSV path; its stem is the analysis name.
+    outfmt : str, optional
+        'csv', 'parquet' or 'both'. The default is 'csv'.
+    root : str, optional
+        Dataset directory. The default is betastore next to path.
+    subj : str, optional
+        Subject of all rows. The default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    if outfmt not in outfmts:
+        raise ValueError(f'Unknown output format {outfmt}, use one of {outfmts}.')
+    if outfmt in ('csv', 'both'):
+        atomic_write(df.to_csv, path)   # no half-written CSVs at the time limit
+    if outfmt in ('parquet', 'both'):
+        if root is None:
+            root = os.path.join(os.path.dirname(path), betastore)
+        save_betas(df, root, analysis_name(path), subj)
+
+
+def subject_reader(root, analysis, columns=None):
+    """ Reader of one subject's betas for average_subjects (subj dropped) """
+    def read(subj):
+        df = read_betas(root, analysis, subjs=[subj], columns=columns)
+        if df.empty:
+            raise FileNotFoundError(f'No {analysis} betas for {subj} in {root}')
+        return df.drop(columns='subj', errors='ignore')
+    return read
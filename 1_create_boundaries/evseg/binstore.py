@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Binary storage for big numeric tables (design matrices etc.)
+
+A table is saved as a plain .npy array (memory-mappable) together with a small
+JSON file holding the column names and any extra info. Reading the .npy with
+mmap_mode='r' lets all jobs on a node share the same page-cached copy instead
+of each parsing its own CSV.
+
+@notes:   first used for the 55 MB perm design matrices
+
+"""
+
+import json
+import numpy as np
+
+
+def _paths(path):
+    """ Split a path into the .npy and .json paths (with or without ext) """
+    stem = path[:-4] if path.endswith(('.npy','.csv')) else path
+    return stem + '.npy', stem + '.json'
+
+
+def save_binary(df, path, dtype=np.float64, columns=None, **info):
+    """
+    Save a numeric DataFrame (or array) as .npy + JSON column index
+
+    Parameters
+    ----------
+    df : DataFrame or ndarray
+        The data, all columns numeric. Arrays can have any number of
+        dimensions, the last one being the columns.
+    path : str
+        Path of the .npy file (the .json gets the same stem).
+    dtype : dtype, optional
+        Dtype of the stored array. The default is float64.
+    columns : list of str, optional
+        Column names, needed only when df is an array.
+    **info : optional
+        Extra JSON-serializable info to save in the index.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    npypath, jsonpath = _paths(path)
+
+    if columns is None:
+        columns = df.columns
+        df = df.to_numpy(dtype=dtype)
+    arr = np.ascontiguousarray(df, dtype=dtype)
+    np.save(npypath, arr, allow_pickle=False)
+
+    index = {'columns': [str(c) for c in columns],
+             'dtype': arr.dtype.name,
+             'shape': list(arr.shape)}
+    index.update(info)
+    with open(jsonpath, 'w') as f:
+        json.dump(index, f)
+
+
+def load_binary(path, mmap_mode='r'):
+    """
+    Load a table saved with save_binary
+
+    Parameters
+    ----------
+    path : str
+        Path of the .npy file (or its stem).
+    mmap_mode : str or None, optional
+        Passed to np.load. The default is 'r' (read-only memory map).
+
+    Returns
+    -------
+    arr : ndarray
+        The data (rows x columns), memory-mapped unless mmap_mode is None.
+    index : dict
+        The JSON index, 'columns' holding the column names.
+
+    """
+
+    npypath, jsonpath = _paths(path)
+
+    arr = np.load(npypath, mmap_mode=mmap_mode, allow_pickle=False)
+    with open(jsonpath) as f:
+        index = json.load(f)
+
+    if list(arr.shape) != index['shape']:
+        raise ValueError(f'{npypath} has shape {arr.shape}, index says {index["shape"]}')
+
+    return arr, index
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Checkpointed fitting of one subject, area block by area block
+
+The areas are fitted a chunk at a time (the fits are vectorized over areas),
+and the betas of every finished area are written at once into a checkpoint
+directory next to the output file, one pickle per area. Every file is
+written under a temporary name and moved into place (os.replace), so a job
+killed at the time limit leaves only complete blocks behind. On resume,
+finished areas are read back and only the missing ones are fitted. The
+inputs of the fit (design files etc., with the size and modification time of
+every input file, see file_stamps) are kept in a small meta.json, and
+checkpoints made with other inputs are thrown away.
+
+Once the whole output is saved, mark_done writes the same meta into a marker
+next to it (<output>.done.json), and only then are the checkpoints removed.
+--resume skips a subject only if the marker is there and its inputs are
+unchanged (is_done): an output half-written at the time limit has no marker,
+and re-cleaned ROI time courses or new design files give other stamps.
+
+@notes:   used by the get*.py drivers (--resume)
+
+"""
+
+import os
+import json
+import shutil
+from urllib.parse import quote
+import pandas as pd
+
+
+def ckpt_dir(savefile):
+    """ Checkpoint directory of an output file """
+    stem, _ = os.path.splitext(savefile)
+    return stem + '.ckpt'
+
+
+def _area_file(ckdir, area):
+    """ Checkpoint file of an area (names made path-safe) """
+    return os.path.join(ckdir, quote(str(area), safe='') + '.pkl')
+
+
+def atomic_write(write, path):
+    """ Call write(tmppath), then move the result to path in one step """
+    tmp = f'{path}.tmp{os.getpid()}'
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _dump(obj, path):
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+
+
+def file_stamps(paths):
+    """ Size and modification time (ns) of each existing file, by path """
+    stamps = {}
+    for p in paths:
+        if os.path.isfile(p):
+            st = os.stat(p)
+            stamps[p] = [st.st_size, st.st_mtime_ns]
+    return stamps
+
+
+def done_file(savefile):
+    """ Marker of a fully saved output file """
+    stem, _ = os.path.splitext(savefile)
+    return stem + '.done.json'
+
+
+def is_done(savefile, meta):
+    """ Whether the output was saved in full, from the same inputs (for --resume) """
+    path = done_file(savefile)
+    if not os.path.isfile(path):
+        return False
+    with open(path) as f:
+        return json.load(f) == meta
+
+
+def mark_done(savefile, meta):
+    """ Mark the output as saved in full (after writing it, before close_checkpoints) """
+    atomic_write(lambda p: _dump(meta, p), done_file(savefile))
+
+
+def clear_done(savefile):
+    """ Remove the marker before the output is written again """
+    if os.path.isfile(done_file(savefile)):
+        os.remove(done_file(savefile))
+
+
+def open_checkpoints(ckdir, meta, resume=False):
+    """
+    Prepare the checkpoint directory
+
+    Parameters
+    ----------
+    ckdir : str
+        Checkpoint directory.
+    meta : dict
+        Inputs of the fit (JSON-serializable); checkpoints with other inputs
+        are not reused.
+    resume : bool, optional
+        Keep the existing checkpoints. The default is False (start over).
+
+    Returns
+    -------
+    kept : bool
+        Whether existing checkpoints were kept.
+
+    """
+
+    metafile = os.path.join(ckdir, 'meta.json')
+    kept = False
+    if resume and os.path.isfile(metafile):
+        with open(metafile) as f:
+            kept = json.load(f) == meta
+    if not kept:
+        shutil.rmtree(ckdir, ignore_errors=True)
+        os.makedirs(ckdir)
+        atomic_write(lambda p: _dump(meta, p), metafile)
+
+    return kept
+
+
+def fit_checkpointed(fit, areas, ckdir, chunk=10, joblog=None):
+    """
+    Fit the areas missing from the checkpoints and collect all betas
+
+    Parameters
+    ----------
+    fit : callable
+        fit(areas) returns the betas of those areas (DataFrame with 'area').
+    areas : list of str
+        All areas, in output order.
+    ckdir : str
+        Checkpoint directory (see open_checkpoints).
+    chunk : int, optional
+        Areas per fit call. The default is 10.
+    joblog : file, optional
+        Log for progress. The default is None.
+
+    Returns
+    -------
+    df_betas : DataFrame
+        Betas of all areas, area by area.
+
+    """
+
+    areas = list(areas)
+    todo = [a for a in areas if not os.path.isfile(_area_file(ckdir, a))]
+    if joblog is not None:
+        joblog.write(f'{len(areas)-len(todo)} areas checkpointed, fitting {len(todo)}.\n')
+
+    for i in range(0, len(todo), chunk):
+        df_chunk = fit(todo[i:i+chunk])
+        for (area,df_area) in df_chunk.groupby('area', sort=False):
+            atomic_write(df_area.to_pickle, _area_file(ckdir, area))
+        if joblog is not None:
+            joblog.write(f'Checkpointed {min(i+chunk, len(todo))}/{len(todo)} areas.\n')
+            joblog.flush()
+
+    df_betas = pd.concat([pd.read_pickle(_area_file(ckdir, a)) for a in areas],
+                         ignore_index=True)
+
+    return df_betas
+
+
+def close_checkpoints(ckdir):
+    """ Remove the checkpoints once the output is saved """
+    shutil.rmtree(ckdir, ignore_errors=True)
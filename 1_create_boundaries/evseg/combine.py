@@ -13,6 +13,8 @@ EVENT SEGMENTATION HELPER FUNCTIONS
 import pandas as pd
 import numpy as np
 
+from . import timeline
+
 def to_concat_rts(df_bounds, df_parts, column='rt'):
     """
     Create concatenated times from part-wise times
@@ -33,174 +35,207 @@ def to_concat_rts(df_bounds, df_parts, column='rt'):
         The concatenated times.
 
     """
-    rt_concat = pd.Series()
-    for i in df_parts.index:
-        p = df_parts.part[i]
-        ind = df_bounds.query('part == @p').index
-        rt_concat = rt_concat.append(df_bounds.loc[ind, column] + df_parts.start[i])
+    rt_concat = timeline.to_concat(df_bounds[column], df_bounds['part'], df_parts)
         
     return rt_concat
 
 
-def chain_concat(dforig, partlens, win1=2, win2=4):
+def _chain(rt, win):
+    """
+    Chain consecutive values into clusters
+
+    A new cluster starts whenever the (absolute) difference to the previous
+    value is at least win.
+
+    Returns
+    -------
+    ids : ndarray
+        Cluster id of each value (1, 2, ...).
+    starts : ndarray
+        Index of the first value of each cluster.
+    sizes : ndarray
+        Number of values in each cluster.
+
+    """
+
+    if len(rt) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    breaks = np.abs(np.diff(rt)) >= win
+    ids = np.cumsum(np.r_[True, breaks])
+    starts = np.r_[0, np.flatnonzero(breaks)+1]
+    sizes = np.diff(np.r_[starts, len(rt)])
+
+    return ids, starts, sizes
 
-    # ----------------------- FIRST ITER -------------------------
-    # Go through all boundaries in the dataset chronologically, marking them
-    # as belonging to the same 1st level cluster as long as the difference
-    # between consecutive boundaries is less than win1.
+
+def chain_first(dforig, win1=2):
+    """
+    First level of chain_concat: chain the annotations with win1
+
+    Parameters
+    ----------
+    dforig : DataFrame
+        All annotations, with columns 'rt_concat' and 'subj'. They are
+        sorted chronologically here (stable), whatever their order.
+    win1 : float, optional
+        Window (sec) of the first level. The default is 2.
+
+    Returns
+    -------
+    df : DataFrame
+        The sorted annotations with the 1st level cluster info
+        ('cluster_id', 'avg_rt', 'num_bounds', 'cluster_len').
+
+    """
+
+    # Mark annotations as belonging to the same 1st level cluster as long as
+    # the difference between consecutive annotations is less than win1.
     # Also calculate the avg rt of the cluster, together with the number of
-    # boundaries, and also the cluster length.
-    # Add this info to a copy of the original dataframe.
-
-    df = dforig.copy()
-    win = win1
-
-    # new data columns
-    cluster = np.zeros(len(df)) # cluster id
-    avg_rt = np.zeros(len(df))  # avg rt of cluster
-    numb = np.zeros(len(df))    # number of boundaries in cluster
-    lenc = np.zeros(len(df))    # length of cluster
-
-    # find and demarcate 1st iter clusters
-    i = 0
-    c = 1
-    while i < len(df):
-
-        # start a new cluster
-        cluster[i] = c
-        this_rt = df.iloc[i]['rt_concat']
-        j = 1
-
-        # look forward for next boundaries
-        while True:
-
-            # if next ind doesn't exist, get out of here
-            if i+j == len(df):
-                avg_rt[i:i+j] = df[i:i+j]['rt_concat'].mean()  # HOX! slicing excludes last ind
-                numb[i:i+j] = j
-                lenc[i:i+j] = df.iloc[i+j-1]['rt_concat'] - df.iloc[i]['rt_concat']
-                i = i+j
-                break
-
-            # next ind exists, get its rt
-            next_rt = df.iloc[i+j]['rt_concat']
-
-            # next is within (moving) window, add to cluster
-            if abs(next_rt - this_rt) < win:
-                cluster[i+j] = c
-                this_rt = next_rt    # chaining
-                j += 1
-            # next is further out, break cluster
-            else:
-                avg_rt[i:i+j] = df[i:i+j]['rt_concat'].mean()  # HOX! slicing excludes last ind
-                numb[i:i+j] = j
-                lenc[i:i+j] = df.iloc[i+j-1]['rt_concat'] - df.iloc[i]['rt_concat']
-                c += 1
-                i = i+j
-                break
+    # boundaries, and also the cluster length, and add them to a copy of the
+    # original dataframe.
+
+    df = dforig.sort_values('rt_concat', kind='stable')
+    rt = df['rt_concat'].to_numpy(dtype=float)
+
+    ids, starts, sizes = _chain(rt, win1)
+    avg_rt = np.add.reduceat(rt, starts) / sizes if len(rt) else np.empty(0)
+    lenc = rt[starts+sizes-1] - rt[starts]
 
     # add cluster info to df
-    df  = df.assign(cluster_id = cluster)
-    df  = df.assign(avg_rt = avg_rt)
-    df  = df.assign(num_bounds = numb)
-    df  = df.assign(cluster_len = lenc)
+    df  = df.assign(cluster_id = ids.astype(float))
+    df  = df.assign(avg_rt = np.repeat(avg_rt, sizes))
+    df  = df.assign(num_bounds = np.repeat(sizes, sizes).astype(float))
+    df  = df.assign(cluster_len = np.repeat(lenc, sizes))
+
+    return df
+
+
+def chain_second(df, partlens, win2=4):
+    """
+    Second level of chain_concat: chain the 1st level clusters with win2
+
+    Parameters
+    ----------
+    df : DataFrame
+        Output of chain_first.
+    partlens : DataFrame
+        Info on parts ('part', 'start').
+    win2 : float, optional
+        Window (sec) of the second level. The default is 4.
+
+    Returns
+    -------
+    dffin, df2nd
+        As from chain_concat.
 
+    """
 
-    # ------------------- SECOND ITER -----------------------------
-    # Go through 1st level clusters and compare their avg rts to decide
-    # which clusters should merge.
-    # First only mark the clusters, then collect the boundaries that might
-    # belong to them, check for duplicate presses from subjects and deal with
-    # them, and finally calculate values for 2nd level clusters: rts, lengths
-    # and saliencies.
+    # Chain the 1st level clusters by their avg rts with win2, then collect
+    # the boundaries that belong to them, deal with duplicate presses from
+    # subjects, and finally calculate values for 2nd level clusters: rts,
+    # lengths and saliencies.
 
     # by default discard clusters with only one boundary at this point
     df1st = df.query('num_bounds > 1')
     df1st = df1st.reset_index(drop=True)
 
-    win = win2
+    # nothing left to chain (e.g. sparse annotations): no final boundaries
+    if df1st.empty:
+        df2nd = df1st.assign(avg_rt2=np.empty(0), cluster2_id=np.empty(0))
+        df2nd[['cluster_id','num_bounds','cluster2_id']] = df2nd[['cluster_id','num_bounds','cluster2_id']].astype(int)
+        dffin = pd.DataFrame(columns=['id','part','rt','rt_concat','clen','nobs'], dtype=float)
+        dffin[['id','part','nobs']] = dffin[['id','part','nobs']].astype(int)
+        return [dffin, df2nd]
 
     # dataframe to map 1st level clusters to 2nd level clusters
-    cols = ['cluster_id','avg_rt','cluster2_id']
-    dfclus = pd.DataFrame(columns=cols, dtype=float)
-    dfclus['cluster_id'] = df1st['cluster_id'].unique() # 1st level id
-    dfclus['avg_rt'] = df1st['avg_rt'].unique()         # 1st level avg rt
-
-    # mark the 2nd level clusters (not yet averaging)
-    i = 0
-    c = 1
-    while i < len(dfclus):
-
-        # start a new cluster
-        dfclus.iloc[i]['cluster2_id'] = c
-        this_rt = dfclus.iloc[i]['avg_rt']
-        j = 1
-
-        while True:
-
-            # if next ind doesn't exist, get out of here
-            if i+j == len(dfclus):
-                i = i+j
-                break
-
-            # next ind exists, get its rt
-            next_rt = dfclus.iloc[i+j]['avg_rt']
-
-            # next is within (moving) window
-            if abs(next_rt - this_rt) < win:
-                dfclus.iloc[i+j]['cluster2_id'] = c
-                this_rt = next_rt    # chaining
-                j += 1
-            # next is further out, break cluster
-            else:
-                c += 1
-                i = i+j
-                break
+    first = ~df1st['cluster_id'].duplicated().to_numpy()
+    dfclus = pd.DataFrame(columns=['cluster_id','avg_rt','cluster2_id'], dtype=float)
+    dfclus['cluster_id'] = df1st['cluster_id'].to_numpy()[first]   # 1st level id
+    dfclus['avg_rt'] = df1st['avg_rt'].to_numpy()[first]           # 1st level avg rt
+    dfclus['cluster2_id'] = _chain(dfclus['avg_rt'].to_numpy(), win2)[0].astype(float)
 
     # join mapping info with other data ==> data for final averaging
     df2nd = df1st.merge(dfclus, on='cluster_id', how='left', suffixes=('','2'))
     df2nd[['cluster_id','num_bounds','cluster2_id']] = df2nd[['cluster_id','num_bounds','cluster2_id']].astype(int)
 
-    # new empty dataset to hold final combined data
-    cols = ['id','part','rt','rt_concat','clen','nobs']
-    dffin = pd.DataFrame(columns=cols, dtype=float)
+    # Average over duplicate subjects within each final cluster: sort rows by
+    # (cluster, subject, position) and reduce each (cluster, subject) run into
+    # one value that takes the place of the subject's first row
+    clus = df2nd['cluster2_id'].to_numpy()
+    subj = pd.factorize(df2nd['subj'])[0]
+    rt = df2nd['rt_concat'].to_numpy(dtype=float)
+    pos = np.arange(len(df2nd))
+
+    order = np.lexsort((pos, subj, clus))
+    new = np.r_[True, (np.diff(clus[order]) != 0) | (np.diff(subj[order]) != 0)]
+    starts = np.flatnonzero(new)
+    sizes = np.diff(np.r_[starts, len(order)])
+    subj_rt = np.add.reduceat(rt[order], starts) / sizes if len(order) else np.empty(0)
+    subj_clus = clus[order][starts]
+    subj_pos = pos[order][starts]
+
+    # Back to original order, and then average into final boundaries
+    order = np.lexsort((subj_pos, subj_clus))
+    subj_rt, subj_clus = subj_rt[order], subj_clus[order]
+    cl_ids, starts, sizes = np.unique(subj_clus, return_index=True, return_counts=True)
+    if len(subj_rt):
+        rts = np.add.reduceat(subj_rt, starts) / sizes
+        clen = np.maximum.reduceat(subj_rt, starts) - np.minimum.reduceat(subj_rt, starts)
+    else:
+        rts = clen = np.empty(0)
+
+    # TODO: if there are several duplicated subjects, we might have a problem
+    # and need to veto the merge!
+
+    # Find out into which part the new boundaries actually fall
+    parts = partlens['part'].to_numpy()[timeline.part_index(rts, partlens)]
+
+    # info on final boundaries
+    dffin = pd.DataFrame({'id': cl_ids,
+                          'part': parts,
+                          'rt': rts - partlens['start'].loc[parts-1].to_numpy(),
+                          'rt_concat': rts,
+                          'clen': clen,
+                          'nobs': sizes}, dtype=float)
 
-    # go through 2nd level clusters and average into final boundaries
-    for i in df2nd['cluster2_id'].unique():
+    dffin[['id','part','nobs']] = dffin[['id','part','nobs']].astype(int)
 
-        # get rows for this final cluster
-        this_df = df2nd.query('cluster2_id == @i')
+    return [dffin, df2nd]
 
-        # check for duplicate subjects
-        dubs = this_df.duplicated(subset='subj', keep=False)
 
-        # if duplicates exist, average over them
-        for s in this_df[dubs]['subj'].unique():
-            new_rt = this_df.loc[this_df.subj == s]['rt_concat'].mean()
-            inds = this_df.loc[this_df.subj == s].index
-            this_df.at[inds[0],'rt_concat'] = new_rt    # new rt to first subj row
-            this_df = this_df.drop(index=inds[1:])      # drop the rest
+def chain_concat(dforig, partlens, win1=2, win2=4):
+    """
+    Chain-combine annotations into final boundaries
 
-        # TODO: if there are several duplicated subjects, we might have a problem
-        # and need to veto the merge!
-        
-        # Find out into which part the new boundary actually falls
-        rt = this_df['rt_concat'].mean()
-        p = partlens.query('start < @rt').iloc[-1].part
-        
-        # save info on final boundary to dffin
-        this_row = {}
-        this_row['id'] = i
-        this_row['part'] = p
-        this_row['rt'] = rt - partlens.start[p-1]
-        this_row['rt_concat'] = rt
-        this_row['clen'] = this_df['rt_concat'].max() - this_df['rt_concat'].min()
-        this_row['nobs'] = this_df['subj'].count()
-        dffin = dffin.append(this_row, ignore_index=True)
+    Two-level chaining as in Ben-Yakov & Henson (2018): annotations are
+    first chained into clusters with the moving window win1, clusters of
+    one are dropped, and the remaining clusters are chained by their
+    average times with win2. Within each final cluster multiple presses
+    from the same subject are averaged into one.
 
-    dffin[['id','part','nobs']] = dffin[['id','part','nobs']].astype(int)
+    Parameters
+    ----------
+    dforig : DataFrame
+        All annotations, with columns 'rt_concat' and 'subj' (sorted
+        chronologically here, see chain_first).
+    partlens : DataFrame
+        Info on parts ('part', 'start').
+    win1 : float, optional
+        Window (sec) of the first level. The default is 2.
+    win2 : float, optional
+        Window (sec) of the second level. The default is 4.
 
-    return [dffin, df2nd]
+    Returns
+    -------
+    dffin : DataFrame
+        The final boundaries.
+    df2nd : DataFrame
+        The annotations that made it to the 2nd level, with cluster info.
+
+    """
+
+    return chain_second(chain_first(dforig, win1), partlens, win2)
 
 
 def to_segments(bounds, len_total, drop=False):
@@ -239,16 +274,56 @@ def to_segments(bounds, len_total, drop=False):
     return diffs
 
 
-def make_permutations(segments, n=1000):
+def iter_permutations(segments, n=1000, chunk=1000, seed=None):
+    """
+    Make N permutations of given segments, chunk by chunk
+
+    All permutations of a chunk are made at once by shuffling each row of a
+    (chunk x segments) tiled matrix and taking the cumulative sum along the
+    rows. For a given seed the stream is the same whatever the chunk size,
+    so it can be used for N in the 100k range without holding all of them.
+
+    Parameters
+    ----------
+    segments : ndarray
+        The segments to shuffle (not modified).
+    n : int, optional
+        Number of permutations. The default is 1000.
+    chunk : int, optional
+        Number of permutations per chunk. The default is 1000.
+    seed : int or Generator, optional
+        Seed or random generator. The default is None (fresh entropy).
+
+    Yields
+    ------
+    perms : ndarray
+        Permutations (boundaries) of one chunk as a bounds x chunk array.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    segments = np.asarray(segments)
+
+    for start in range(0, n, chunk):
+        m = min(chunk, n - start)
+        shuffled = rng.permuted(np.tile(segments, (m,1)), axis=1)
+        rts = shuffled.cumsum(axis=1)    # boundaries from segments
+        yield rts[:,:-1].T
+
+
+def make_permutations(segments, n=1000, seed=None):
     """
     Make N permutations of given segments
 
     Parameters
     ----------
     segments : ndarray
-        The segments to shuffle.
+        The segments to shuffle (not modified).
     n : int, optional
         Number of permutations The default is 1000.
+    seed : int or Generator, optional
+        Seed or random generator, for reproducible perms. The default is
+        None (fresh entropy).
 
     Returns
     -------
@@ -256,15 +331,127 @@ def make_permutations(segments, n=1000):
         All permutations (boundaries) as a bounds x N array.
 
     """
-    
-    perms = np.zeros([len(segments)-1,n])
-    
-    for i in range(n):
-        np.random.shuffle(segments)
-        rts = segments.cumsum()    # boundaries from segments
-        perms[:,i] = rts[:-1]
-    
-    return perms
 
+    return next(iter_permutations(segments, n, chunk=n, seed=seed))
+
+
+def sample_spaced(times, k, min_gap, n=1000, seed=None):
+    """
+    Sample N sets of k times with all spacings > min_gap, without rejection
+
+    Uniform over all valid subsets, i.e. the same distribution as drawing k
+    times at random until the spacing is fine, but each set is drawn in one
+    pass. With C[r][i] = number of valid r-subsets among sorted times i..end,
+    the sorted times are walked through once, and time i is taken with
+    probability C[r-1][next(i)] / C[r][i], where r is the number still to
+    take and next(i) the first time more than min_gap after time i.
+
+    Parameters
+    ----------
+    times : array_like
+        Candidate times (e.g. gap times, sec).
+    k : int
+        Times per set.
+    min_gap : float
+        Minimum spacing (sec) between the times of a set (strict).
+    n : int, optional
+        Number of sets. The default is 1000.
+    seed : int or Generator, optional
+        Seed or random generator. The default is None (fresh entropy).
+
+    Returns
+    -------
+    inds : ndarray
+        Positions in times of each set, sorted by time, as a k x N array.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    times = np.asarray(times, dtype=float)
+    order = np.argsort(times, kind='stable')
+    t = times[order]
+    M = len(t)
+    nxt = np.searchsorted(t, t + min_gap, side='right')
+
+    # feasibility counts (float: they get large, only the ratios matter)
+    C = np.zeros((k+1, M+1))
+    C[0] = 1
+    for r in range(1, k+1):
+        for i in range(M-1, -1, -1):
+            C[r,i] = C[r,i+1] + C[r-1,nxt[i]]
+    if C[k,0] == 0:
+        raise ValueError(f'No set of {k} times with spacing > {min_gap}.')
+
+    # walk all sets through the times at once
+    inds = np.empty((k, n), dtype=int)
+    left = np.full(n, k)          # times still to take
+    allowed = np.zeros(n, dtype=int)   # first position allowed
+    for i in range(M):
+        active = (left > 0) & (allowed <= i)
+        if not active.any():
+            continue
+        r = left[active]
+        p = C[r-1, nxt[i]] / C[r, i]
+        take = np.flatnonzero(active)[rng.random(len(r)) < p]
+        inds[k - left[take], take] = i
+        left[take] -= 1
+        allowed[take] = nxt[i]
+
+    return order[inds]
+
+
+def match_gaps(t, off, on, win=2):
+    """
+    Match times to the nearest gap, within win of its edges
+
+    Gaps are intervals (off, on), sorted and not overlapping. A time is
+    matched when off - win < t < on + win for some gap; of several such gaps
+    the nearest (distance to the interval, 0 inside) is taken, a tie going
+    to the later gap. Everything is done with searchsorted, for times of any
+    shape (e.g. bounds x perms).
+
+    Parameters
+    ----------
+    t : array_like
+        The times.
+    off : array_like
+        Gap offsets (audio off), sorted.
+    on : array_like
+        Gap onsets (audio on), same order.
+    win : float, optional
+        Leeway around the gaps (sec). The default is 2.
+
+    Returns
+    -------
+    inds : ndarray
+        Position of the matched gap, -1 if none; shape of t.
+    dist : ndarray
+        Distance to the matched gap (nan if none).
+    ncand : ndarray
+        Number of gaps within win (> 1 means the others were passed over).
+
+    """
+
+    t = np.asarray(t, dtype=float)
+    off, on = np.asarray(off, dtype=float), np.asarray(on, dtype=float)
+    n = len(off)
+
+    # the last gap starting at or before t, and the next one
+    j = np.searchsorted(off, t, side='right') - 1
+    d_prev = np.where(j >= 0, np.maximum(t - on[np.clip(j, 0, n-1)], 0), np.inf)
+    d_next = np.where(j+1 < n, off[np.clip(j+1, 0, n-1)] - t, np.inf)
+
+    use_next = d_next <= d_prev
+    inds = np.where(use_next, j+1, j)
+    dist = np.where(use_next, d_next, d_prev)
+
+    ok = dist < win
+    inds = np.where(ok, inds, -1)
+    dist = np.where(ok, dist, np.nan)
 
+    # all gaps within win: on + win > t and off - win < t
+    lo = np.searchsorted(on + win, t, side='right')
+    hi = np.searchsorted(off - win, t, side='left')
+    ncand = np.maximum(hi - lo, 0)
 
+    return inds, dist, ncand
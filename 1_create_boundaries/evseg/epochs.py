@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Epoching part-wise signals (audio envelopes) around event times
+
+All parts are edge-padded and concatenated once, and epochs are strided
+windows (sliding_window_view) of that, picked by fancy indexing. So the times
+can be of any shape, e.g. bounds x 1000 perms, and epochs near the start or
+end of a chapter are padded with the edge value instead of coming out short.
+
+@notes:   used by calcAudConfounds
+
+"""
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def pad_parts(xs, pad):
+    """
+    Edge-pad each part and concatenate
+
+    Parameters
+    ----------
+    xs : dict
+        Signal of each part (1-D arrays).
+    pad : int
+        Samples of padding on both sides of each part.
+
+    Returns
+    -------
+    x : ndarray
+        The padded parts, concatenated.
+    starts : dict
+        Position of sample 0 of each part in x.
+    lens : dict
+        Length of each part (without the padding).
+
+    """
+
+    starts, lens, padded, pos = {}, {}, [], 0
+    for (p,xp) in xs.items():
+        starts[p], lens[p] = pos + pad, len(xp)
+        padded.append(np.pad(np.asarray(xp, dtype=float), pad, mode='edge'))
+        pos += len(xp) + 2*pad
+
+    return np.concatenate(padded), starts, lens
+
+
+def get_epochs(xs, parts, t, win, d, pad=None):
+    """
+    Epochs of win samples around times, from part-wise signals
+
+    Epoch of time t starts win // 2 samples before sample int(t*d), i.e. the
+    sample of t is at index win // 2 of the epoch.
+
+    Parameters
+    ----------
+    xs : dict
+        Signal of each part (1-D arrays sampled at d Hz).
+    parts : array_like
+        Part of each time.
+    t : array_like
+        Part-wise times (sec), any shape (same as parts).
+    win : int
+        Epoch length (samples).
+    d : float
+        Sampling rate of the signals (Hz).
+    pad : int, optional
+        Edge padding of the parts, at least win. The default is win.
+
+    Returns
+    -------
+    epochs : ndarray
+        Shape of t + (win,).
+
+    """
+
+    pad = win if pad is None else pad
+    x, starts, lens = pad_parts(xs, pad)
+    return _epochs(x, starts, lens, parts, t, win, d)
+
+
+def _epochs(x, starts, lens, parts, t, win, d):
+    """ get_epochs on an already padded signal """
+    parts, t = np.broadcast_arrays(np.asarray(parts), np.asarray(t, dtype=float))
+    uparts = list(starts)
+    pinds = pd.Index(uparts).get_indexer(parts.ravel()).reshape(parts.shape)
+    if (pinds < 0).any():
+        raise ValueError(f'Unknown parts: {np.unique(parts[pinds < 0])}')
+    start0 = np.array([starts[p] for p in uparts])[pinds]
+    n = np.array([lens[p] for p in uparts])[pinds]
+
+    # the sample of t, kept within the part (edges are padded)
+    i = np.clip(np.trunc(t*d).astype(int), 0, n-1)
+
+    windows = sliding_window_view(x, win)
+    return windows[start0 + i - win // 2]
+
+
+def vol_confounds(envs, parts, t, wins, d):
+    """
+    Mean volume and volume change around times, for several windows
+
+    For a window of win samples (half = win // 2 on each side):
+        meanvol = mean of the epoch
+        voldiff = mean after the time - mean up to and including it
+    i.e. > 0 means increasing volume.
+
+    Parameters
+    ----------
+    envs : dict
+        Envelope of each part (sampled at d Hz).
+    parts : array_like
+        Part of each time.
+    t : array_like
+        Part-wise times (sec), any shape (e.g. bounds x perms).
+    wins : list of float
+        Window lengths (sec).
+    d : float
+        Sampling rate of the envelopes (Hz).
+
+    Returns
+    -------
+    meanvol : ndarray
+        Shape of t + (len(wins),).
+    voldiff : ndarray
+        Shape of t + (len(wins),).
+
+    """
+
+    wins_s = [int(round(w*d)) for w in wins]
+    x, starts, lens = pad_parts(envs, max(wins_s))
+
+    meanvol = np.empty(np.broadcast(np.asarray(parts), np.asarray(t)).shape + (len(wins),))
+    voldiff = np.empty_like(meanvol)
+    for (j,win) in enumerate(wins_s):
+        epochs = _epochs(x, starts, lens, parts, t, win, d)
+        half = win // 2
+        meanvol[...,j] = epochs.mean(axis=-1)
+        voldiff[...,j] = epochs[...,half+1:].mean(axis=-1) - epochs[...,:half+1].mean(axis=-1)
+
+    return meanvol, voldiff
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Accumulating results into preallocated columns
+
+@notes:   replaces DataFrame.append loops (quadratic, and gone in pandas 2)
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class ResultBuffer:
+    """
+    Preallocated columnar buffer for results
+
+    Holds one NumPy array per column, sized up front for the whole result
+    (e.g. areas x perms, or areas x conds x delays rows). Blocks of rows are
+    written in order with add(), and the DataFrame is only materialized once
+    at the end with to_frame(). If more rows come than were expected (e.g.
+    a later subject with an extra area), the columns grow (doubling).
+
+    Parameters
+    ----------
+    columns : dict
+        Column names mapped to their dtypes, in output order.
+    nrows : int
+        Number of rows to preallocate.
+
+    """
+
+    def __init__(self, columns, nrows):
+        self.nrows = int(nrows)
+        self.cols = {c: np.empty(self.nrows, dtype=dt) for (c,dt) in columns.items()}
+        self.pos = 0
+
+    @classmethod
+    def like(cls, df, nrows, **extra):
+        """
+        Buffer with the same columns (and dtypes) as a DataFrame
+
+        Parameters
+        ----------
+        df : DataFrame
+            Template, e.g. the first of several files to be stacked.
+        nrows : int
+            Number of rows to preallocate (the expected total).
+        **extra : dtype
+            Additional columns (appended last) and their dtypes.
+
+        Returns
+        -------
+        buf : ResultBuffer
+            The empty buffer.
+
+        """
+
+        columns = {c: df[c].to_numpy().dtype for c in df.columns}
+        columns.update(extra)
+
+        return cls(columns, nrows)
+
+    def add(self, **values):
+        """
+        Write the next block of rows
+
+        Values can be scalars or 1D arrays; scalars are broadcast to the
+        length of the arrays (or written as a single row if all are scalars).
+        Columns not given are left unfilled.
+
+        Parameters
+        ----------
+        **values : scalar or array_like
+            Values by column name.
+
+        Returns
+        -------
+        rows : slice
+            The rows that were written.
+
+        """
+
+        lens = [np.size(v) for v in values.values() if np.ndim(v) > 0]
+        n = lens[0] if lens else 1
+        if any(l != n for l in lens):
+            raise ValueError(f'Block columns differ in length: {lens}')
+        if self.pos + n > self.nrows:
+            self._grow(max(2*self.nrows, self.pos + n))
+
+        rows = slice(self.pos, self.pos+n)
+        for (c,v) in values.items():
+            self.cols[c][rows] = v
+        self.pos += n
+
+        return rows
+
+    def _grow(self, nrows):
+        """ Reallocate the columns to hold nrows rows """
+        for (c,arr) in self.cols.items():
+            new = np.empty(nrows, dtype=arr.dtype)
+            new[:self.pos] = arr[:self.pos]
+            self.cols[c] = new
+        self.nrows = nrows
+
+    def add_frame(self, df, **values):
+        """
+        Write all rows of a DataFrame as the next block
+
+        Parameters
+        ----------
+        df : DataFrame
+            The rows to add, columns matched by name.
+        **values : scalar or array_like
+            Values for any additional columns (e.g. subject).
+
+        Returns
+        -------
+        rows : slice
+            The rows that were written.
+
+        """
+
+        cols = {c: df[c].to_numpy() for c in df.columns}
+        cols.update(values)
+
+        return self.add(**cols)
+
+    def to_frame(self):
+        """
+        Materialize the filled rows as a DataFrame
+
+        Returns
+        -------
+        df : DataFrame
+            The results, with a fresh RangeIndex.
+
+        """
+
+        return pd.DataFrame({c: arr[:self.pos] for (c,arr) in self.cols.items()})
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Saving and loading the ROI time courses
+
+Next to the tc_hoahc_concat.csv of each subject, getROItcs saves a binary
+copy (float32 .npy, run index kept separately as run lengths in the .json),
+and a stacked subjects x TR x ROI array for the whole cohort. The loaders
+pick the binary form whenever it exists and fall back to the CSV.
+
+@notes:   all get*.py drivers and avgROItcs load through here
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from .binstore import save_binary, load_binary
+
+roifile = 'tc_hoahc_concat'     # per subject, in savedir/subj
+rawfile = 'tc_hoahc_raw'        # raw ROI means (before cleaning), per subject
+cohortfile = 'tc_hoahc_cohort'  # all subjects, in savedir
+
+
+def _runinfo(runind):
+    """ Run index (contiguous runs) to run ids and lengths """
+    runind = np.asarray(runind)
+    if np.any(np.diff(runind) < 0):
+        raise ValueError('Run index is not in order, cannot store as run lengths.')
+    runs, runlens = np.unique(runind, return_counts=True)
+    return [int(r) for r in runs], [int(n) for n in runlens]
+
+
+def save_roi(df_roi, savepath, name=roifile, dtype=np.float32):
+    """
+    Save ROI time courses of one subject as binary (float32 by default)
+
+    Parameters
+    ----------
+    df_roi : DataFrame
+        ROI time courses (TR x ROI), with the run index as column 'runind'.
+    savepath : str
+        Directory of the subject.
+    name : str, optional
+        File stem. The default is roifile.
+    dtype : dtype, optional
+        Stored dtype. The default is float32.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    runs, runlens = _runinfo(df_roi['runind'])
+    save_binary(df_roi.drop(columns='runind'), os.path.join(savepath, name+'.npy'),
+                dtype=dtype, runs=runs, runlens=runlens)
+
+
+def load_roi(savepath, name=roifile, mmap_mode='r'):
+    """
+    Load ROI time courses of one subject, binary if available
+
+    Parameters
+    ----------
+    savepath : str
+        Directory of the subject.
+    name : str, optional
+        File stem. The default is roifile.
+    mmap_mode : str or None, optional
+        Passed to np.load for the binary. The default is 'r'.
+
+    Returns
+    -------
+    df_roi : DataFrame
+        ROI time courses (TR x ROI), run index as the last column 'runind',
+        i.e. the same layout as the CSV.
+
+    """
+
+    path = os.path.join(savepath, name)
+    if not os.path.isfile(path+'.npy'):
+        return pd.read_csv(path+'.csv', index_col=0)
+
+    arr, index = load_binary(path+'.npy', mmap_mode=mmap_mode)
+    df_roi = pd.DataFrame(arr, columns=index['columns'])
+    df_roi['runind'] = np.repeat(index['runs'], index['runlens'])
+
+    return df_roi
+
+
+def roi_inputs(savepath, name=roifile):
+    """ Files load_roi may read for a subject (binary and CSV) """
+    path = os.path.join(savepath, name)
+    return [path+'.npy', path+'.csv']
+
+
+def save_cohort(savedir, subjs, name=roifile, cohort=cohortfile):
+    """
+    Stack the ROI time courses of all subjects into one binary
+
+    Parameters
+    ----------
+    savedir : str
+        Data directory containing the subject directories.
+    subjs : list of str
+        The subjects, in order.
+    name : str, optional
+        File stem of subject files. The default is roifile.
+    cohort : str, optional
+        File stem of the cohort file. The default is cohortfile.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    subjs = list(subjs)
+    arr = None
+    for (i,subj) in enumerate(subjs):
+        df_roi = load_roi(os.path.join(savedir, subj), name)
+        if arr is None:
+            cols = df_roi.columns[:-1]
+            runs, runlens = _runinfo(df_roi['runind'])
+            arr = np.empty((len(subjs), len(df_roi), len(cols)), dtype=np.float32)
+        if _runinfo(df_roi['runind']) != (runs, runlens):
+            raise ValueError(f'Runs of {subj} do not match those of {subjs[0]}.')
+        arr[i] = df_roi[cols].to_numpy(dtype=np.float32)
+
+    save_binary(arr, os.path.join(savedir, cohort+'.npy'), dtype=np.float32,
+                columns=cols, subjs=subjs, runs=runs, runlens=runlens)
+
+
+def load_cohort(savedir, cohort=cohortfile, mmap_mode='r'):
+    """
+    Load the stacked ROI time courses of all subjects
+
+    Parameters
+    ----------
+    savedir : str
+        Data directory.
+    cohort : str, optional
+        File stem of the cohort file. The default is cohortfile.
+    mmap_mode : str or None, optional
+        Passed to np.load. The default is 'r'.
+
+    Returns
+    -------
+    arr : ndarray
+        Time courses as subjects x TR x ROI (float32).
+    subjs : list of str
+        The subjects, in the order of the first axis.
+    columns : list of str
+        The ROIs, in the order of the last axis.
+    runind : ndarray
+        Run index of each TR.
+
+    """
+
+    arr, index = load_binary(os.path.join(savedir, cohort+'.npy'), mmap_mode=mmap_mode)
+    runind = np.repeat(index['runs'], index['runlens'])
+
+    return arr, index['subjs'], index['columns'], runind
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Extracting ROI time courses of several atlases in one pass
+
+Instead of one NiftiLabelsMasker per atlas (each loading, resampling and
+masking the same 4D run again), the labels of all atlases are resampled to
+the data grid once and merged into one index: the voxels of every ROI, as
+flat voxel indices, laid out ROI after ROI. A voxel in two atlases (e.g. the
+cortical and hippocampal ones) simply appears in both ROIs. Each run is then
+read once, and all ROI means come out of one reduction over the voxels
+(np.add.reduceat over the ROI-ordered voxels), straight into a preallocated
+TR x ROI array.
+
+Runs are read a block of volumes at a time by slicing the image's data
+proxy (memory-mapped for uncompressed .nii, so only those volumes are read),
+so the peak memory of a worker is set by the block size, roughly
+block x voxels x 8 bytes, and not by the length of the run.
+
+The label index depends only on the atlases and the data grid (all subjects
+are on the same MNI152 2 mm grid), so cached_label_index computes it once and
+saves it (see binstore), named by a hash of the grid (affine & shape) and of
+the atlases. Later calls, for any run, subject or re-extraction, load it
+after checking the grid; new atlases just get a new cache file.
+
+For voxelwise analyses, extract_voxels streams the time courses of the
+voxels of a mask (a one-label index) the same way into a TR x voxel array,
+typically a memory-mapped .npy, which is then fitted a chunk of voxels at a
+time; to_img puts per-voxel results back into a NIfTI.
+
+Extraction gives the raw ROI means, which getROItcs keeps (tc_hoahc_raw),
+and cleaning is a separate stage on the TR x ROI array: clean_tcs detrends
+every run with a polynomial of the chosen order and scales it (zscore or
+percent signal change), all runs and ROIs at once. So changing the cleaning
+means re-running clean_tcs on the raw means, not re-reading the NIfTIs. The
+default (linear detrend, zscore) is the masker's detrend=True,
+standardize='zscore'.
+
+@notes:   checked against NiftiLabelsMasker (same time courses up to float32)
+
+"""
+
+import os
+import hashlib
+import numpy as np
+import nibabel as nib
+from nilearn.image import load_img, resample_to_img
+
+from .binstore import save_binary, load_binary
+
+
+def grid_hash(img):
+    """ Hash of the voxel grid (affine & 3D shape) of an image """
+    h = hashlib.sha1(np.asarray(img.shape[:3], dtype=np.int64).tobytes())
+    h.update(np.round(np.asarray(img.affine, dtype=np.float64), 6).tobytes())
+    return h.hexdigest()[:16]
+
+
+def _atlas_hash(label_imgs):
+    """ Hash of the label images (grid and labels) """
+    h = hashlib.sha1()
+    for img in label_imgs:
+        img = load_img(img)
+        h.update(grid_hash(img).encode())
+        h.update(np.ascontiguousarray(img.dataobj).tobytes())
+    return h.hexdigest()[:16]
+
+
+def label_index(label_imgs, target):
+    """
+    Merge the ROIs of several label images into one voxel index
+
+    Parameters
+    ----------
+    label_imgs : list of Niimg
+        Label images (0 is background), each resampled to the target grid
+        (nearest neighbour, as in NiftiLabelsMasker).
+    target : Niimg
+        Image on the data grid, e.g. a run (only the header is used).
+
+    Returns
+    -------
+    vox : ndarray
+        Flat voxel indices (Fortran order, as NIfTI data is stored) of all
+        ROIs, ROI after ROI.
+    starts : ndarray
+        Position of the first voxel of each ROI in vox.
+    labels : list of (int, float)
+        Atlas number and label value of each ROI; within an atlas ROIs come
+        in order of label value, as the masker returns them.
+
+    """
+
+    vox, starts, labels, pos = [], [], [], 0
+    for (a,img) in enumerate(label_imgs):
+        img = resample_to_img(img, target, interpolation='nearest')
+        data = np.asarray(img.dataobj).ravel(order='F')
+        inds = np.flatnonzero(data)
+        order = np.argsort(data[inds], kind='stable')
+        values, counts = np.unique(data[inds], return_counts=True)
+
+        vox.append(inds[order])
+        starts.append(pos + np.r_[0, np.cumsum(counts)[:-1]])
+        labels += [(a, float(v)) for v in values]
+        pos += len(inds)
+
+    return np.concatenate(vox), np.concatenate(starts), labels
+
+
+def cached_label_index(label_imgs, target, cachedir):
+    """
+    label_index, computed once per atlases and grid and cached on disk
+
+    Parameters
+    ----------
+    label_imgs : list of Niimg
+        Label images (0 is background).
+    target : Niimg
+        Image on the data grid, e.g. a run (only the header is used).
+    cachedir : str
+        Directory of the cache files.
+
+    Returns
+    -------
+    vox, starts, labels
+        As from label_index.
+
+    """
+
+    grid = grid_hash(target)
+    path = os.path.join(cachedir, f'labelindex_{grid}_{_atlas_hash(label_imgs)}.npy')
+
+    if not os.path.isfile(path):
+        vox, starts, labels = label_index(label_imgs, target)
+        # written under a temporary name, so parallel jobs never read half a cache
+        tmp = os.path.join(cachedir, f'tmp{os.getpid()}_' + os.path.basename(path))
+        save_binary(vox[:,np.newaxis], tmp, dtype=np.int64, columns=['vox'],
+                    starts=starts.tolist(), labels=labels, grid=grid,
+                    grid_shape=list(target.shape[:3]),
+                    grid_affine=np.asarray(target.affine).tolist())
+        os.replace(tmp[:-4]+'.json', path[:-4]+'.json')
+        os.replace(tmp, path)
+
+    arr, index = load_binary(path, mmap_mode=None)
+    if index['grid'] != grid or index['grid_shape'] != list(target.shape[:3]) \
+            or not np.allclose(index['grid_affine'], target.affine, atol=1e-6):
+        raise ValueError(f'{path} was made for another grid.')
+
+    return arr[:,0], np.asarray(index['starts']), [tuple(l) for l in index['labels']]
+
+
+def label_means(data, vox, starts):
+    """
+    Means of all ROIs for each volume, in one reduction
+
+    Parameters
+    ----------
+    data : ndarray
+        Volumes as TR x voxels (flattened in Fortran order).
+    vox : ndarray
+        Voxel indices, ROI after ROI (from label_index).
+    starts : ndarray
+        First position of each ROI in vox (every ROI non-empty).
+
+    Returns
+    -------
+    means : ndarray
+        TR x ROI.
+
+    """
+
+    counts = np.diff(np.r_[starts, len(vox)])
+    sums = np.add.reduceat(data[:, vox], starts, axis=1, dtype=np.float64)
+    return sums / counts
+
+
+def clean_tcs(tcs, runind, order=1, scale='zscore'):
+    """
+    Detrend and scale each run of ROI time courses
+
+    Parameters
+    ----------
+    tcs : ndarray
+        Raw ROI means, TR x ROI.
+    runind : ndarray
+        Run of each TR.
+    order : int or None, optional
+        Order of the polynomial removed from each run (0 = mean, 1 = linear
+        trend, ...), or None for no detrending. The default is 1.
+    scale : str or None, optional
+        'zscore' (divide by the std of the run), 'psc' (percent of the raw
+        run mean) or None. The run mean is removed in any case when scaling.
+        The default is 'zscore'.
+
+    Returns
+    -------
+    clean : ndarray
+        The cleaned time courses, TR x ROI (float64).
+
+    """
+
+    if scale not in ('zscore', 'psc', None):
+        raise ValueError(f'Unknown scaling {scale}, use zscore, psc or None.')
+    tcs = np.asarray(tcs, dtype=np.float64)
+    runs, inv, n = np.unique(runind, return_inverse=True, return_counts=True)
+    onehot = (inv[:,np.newaxis] == np.arange(len(runs))).astype(float)
+    means = (onehot.T @ tcs) / n[:,np.newaxis]            # runs x ROI
+
+    # polynomials of all runs as one block-diagonal design, time within each
+    # run scaled to [-1, 1] (for conditioning)
+    if order is None:
+        order = 0 if scale is not None else -1
+    clean = tcs.copy()
+    if order >= 0:
+        srt = np.argsort(inv, kind='stable')
+        t = np.empty(len(inv))
+        t[srt] = np.arange(len(inv)) - np.r_[0, np.cumsum(n)][inv[srt]]
+        t = 2 * t / np.maximum(n[inv]-1, 1) - 1
+        X = np.hstack([onehot * t[:,np.newaxis]**k for k in range(order+1)])
+        clean -= X @ np.linalg.lstsq(X, tcs, rcond=None)[0]
+
+    if scale == 'zscore':
+        std = np.sqrt((onehot.T @ clean**2) / n[:,np.newaxis])
+        std[std < np.finfo(np.float64).eps] = 1.
+        clean /= std[inv]
+    elif scale == 'psc':
+        clean *= 100 / np.abs(means)[inv]
+
+    return clean
+
+
+def run_index(files):
+    """ Run number (position in files) of each TR, from the headers """
+    return np.repeat(np.arange(len(files)), [nib.load(f).shape[3] for f in files])
+
+
+def extract_voxels(files, vox, out, block=50):
+    """
+    Time courses of single voxels, several runs concatenated
+
+    Parameters
+    ----------
+    files : list of str
+        4D NIfTI of each run (all on the grid of the voxel index).
+    vox : ndarray
+        Flat voxel indices (Fortran order), e.g. from label_index of a mask.
+    out : ndarray
+        Output, TR x voxels, e.g. a memory-mapped .npy (np.lib.format.open_memmap).
+    block : int, optional
+        Volumes read at a time; sets the peak memory. The default is 50.
+
+    Returns
+    -------
+    out : ndarray
+        The filled output (raw, not cleaned).
+
+    """
+
+    pos = 0
+    for f in files:
+        img = nib.load(f)
+        n = img.shape[3]
+        for t in range(0, n, block):
+            m = min(block, n-t)
+            data = np.asarray(img.dataobj[..., t:t+m], dtype=np.float32)
+            out[pos+t:pos+t+m] = data.reshape(-1, m, order='F')[vox].T
+        pos += n
+
+    return out
+
+
+def to_img(values, vox, target, fill=0.):
+    """ Per-voxel values (at vox) as a 3D NIfTI on the grid of target """
+    data = np.full(int(np.prod(target.shape[:3])), fill, dtype=np.float32)
+    data[vox] = values
+    return nib.Nifti1Image(data.reshape(target.shape[:3], order='F'), target.affine)
+
+
+def extract_runs(files, vox, starts, block=50):
+    """
+    Raw ROI means of several runs, each run read once
+
+    Parameters
+    ----------
+    files : list of str
+        4D NIfTI of each run (all on the grid of the label index).
+    vox : ndarray
+        Voxel indices, ROI after ROI (from label_index).
+    starts : ndarray
+        First position of each ROI in vox.
+    block : int, optional
+        Volumes read at a time; sets the peak memory. The default is 50.
+
+    Returns
+    -------
+    tcs : ndarray
+        All runs concatenated, TR x ROI.
+    runind : ndarray
+        Run number (position in files) of each TR.
+
+    """
+
+    imgs = [nib.load(f) for f in files]
+    if len({grid_hash(img) for img in imgs}) > 1:
+        raise ValueError('The runs are not all on the same grid.')
+    lens = [img.shape[3] for img in imgs]
+    tcs = np.empty((sum(lens), len(starts)))
+    runind = np.repeat(np.arange(len(files)), lens)
+
+    pos = 0
+    for (img,n) in zip(imgs, lens):
+        tc = tcs[pos:pos+n]
+        for t in range(0, n, block):
+            m = min(block, n-t)
+            data = np.asarray(img.dataobj[..., t:t+m], dtype=np.float32)
+            tc[t:t+m] = label_means(data.reshape(-1, m, order='F').T, vox, starts)
+        pos += n
+
+    return tcs, runind
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Parameter sweep for the boundary combination (checkParams)
+
+@notes:   grid of react_time x win1 x win2 x nobs threshold
+
+"""
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from . import combine, timeline
+
+
+def shift_concat(df, partlens, react_time):
+    """
+    Remove reaction time and make concatenated times
+
+    Parameters
+    ----------
+    df : DataFrame
+        All annotations, with columns 'subj', 'part' and 'rt'.
+    partlens : DataFrame
+        Info on parts ('part', 'start').
+    react_time : float
+        Reaction time (sec) to subtract; negative rts are set to 0.
+
+    Returns
+    -------
+    df_concat : DataFrame
+        The annotations with adjusted 'rt' and 'rt_concat' (in the input
+        order, as in makeBoundaries; chain_concat sorts them).
+
+    """
+
+    df_concat = df[['subj','part','rt']].copy()
+    df_concat['rt'] = (df_concat['rt'] - react_time).clip(lower=0)
+    df_concat['rt_concat'] = timeline.to_concat(df_concat['rt'], df_concat['part'], partlens)
+
+    return df_concat
+
+
+def _describe(x, prefix):
+    """ Mean, sd, min and max of x, keys prefixed (nans if too few values) """
+    x = np.asarray(x, dtype=float)
+    stats = dict.fromkeys(['mean','sd','min','max'], np.nan)
+    if len(x) > 0:
+        stats.update(mean=x.mean(), min=x.min(), max=x.max())
+    if len(x) > 1:
+        stats['sd'] = x.std(ddof=1)
+    return {f'{prefix}_{k}': v for (k,v) in stats.items()}
+
+
+def _sweep_cell(df_concat, partlens, react_time, win1, wins2, ths):
+    """ Chain the 1st level once with win1, then all win2 and thresholds """
+
+    df1st = combine.chain_first(df_concat, win1)
+
+    rows = []
+    for win2 in wins2:
+        rows += _threshold_stats(combine.chain_second(df1st, partlens, win2)[0],
+                                 partlens, react_time, win1, win2, ths)
+
+    return rows
+
+
+def _threshold_stats(dffin, partlens, react_time, win1, win2, ths):
+    """ Stats of the final boundaries for all thresholds """
+
+    rows = []
+    for th in ths:
+        df_th = dffin[dffin['nobs'] > th]
+
+        # segments part by part, as in makeBoundaries
+        segs = [combine.to_segments(df_th.loc[df_th['part'] == p, 'rt'], len_total=l)
+                for (p,l) in zip(partlens['part'], partlens['len'])]
+        segs = np.concatenate(segs)
+
+        row = {'react_time': react_time, 'win1': win1, 'win2': win2, 'th': th,
+               'nbounds': len(df_th)}
+        row.update(_describe(segs, 'seg'))
+        row.update(_describe(df_th['clen'].to_numpy(), 'clen'))
+        rows.append(row)
+
+    return rows
+
+
+def sweep_params(df, partlens, react_times, wins1, wins2, ths, n_jobs=-1):
+    """
+    Evaluate the boundary combination over a grid of parameters
+
+    The shifted concatenated times are computed once per reaction time.
+    The (react_time, win1) cells run in parallel; each chains the 1st level
+    once (chain_first), and then the 2nd level for every win2 from those
+    clusters (chain_second), applying all thresholds.
+
+    Parameters
+    ----------
+    df : DataFrame
+        All annotations, with columns 'subj', 'part' and 'rt'.
+    partlens : DataFrame
+        Info on parts ('part', 'len', 'start').
+    react_times : list of float
+        Reaction times (sec).
+    wins1 : list of float
+        Windows of the 1st level chaining (sec).
+    wins2 : list of float
+        Windows of the 2nd level chaining (sec).
+    ths : list of int
+        Thresholds, boundaries with nobs > th are kept.
+    n_jobs : int, optional
+        Number of parallel jobs. The default is -1 (all cores).
+
+    Returns
+    -------
+    df_sweep : DataFrame
+        One row per (react_time, win1, win2, th) with the number of
+        boundaries, and mean/sd/min/max of segment and cluster lengths.
+
+    """
+
+    concats = {rt: shift_concat(df, partlens, rt) for rt in react_times}
+
+    cells = [(rt,w1) for rt in react_times for w1 in wins1]
+    res = Parallel(n_jobs=n_jobs) (delayed(_sweep_cell) (concats[rt], partlens, rt, w1, wins2, ths)
+                                   for (rt,w1) in cells)
+
+    return pd.DataFrame([row for rows in res for row in rows])
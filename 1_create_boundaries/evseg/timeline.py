@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION HELPER FUNCTIONS
+Mapping times between the audio parts, audio concat and fMRI concat
+
+The timeframes, all in seconds:
+    part time      time from the start of the part (rt, frt)
+    audio concat   part time + start of the part (rt_concat)
+    fMRI concat    part time - fmri_offset + fstart of the part (frt_concat)
+
+The fMRI data starts 1 sec later than the audio (the temporal smoothing
+ditches the first and last second), hence fmri_offset. All functions take
+arrays of any shape (e.g. bounds x N perms) and use partlensf.csv as
+partlens, with columns 'part', 'start' and 'fstart'.
+
+@notes:   replaces the part-by-part query loops in the scripts
+
+"""
+
+import numpy as np
+import pandas as pd
+
+fmri_offset = 1
+
+
+def part_index(t_concat, partlens, column='start'):
+    """
+    Find the part each concatenated time falls into
+
+    A time exactly at the start of a part belongs to the previous part
+    (times at or before the first start belong to the first part).
+
+    Parameters
+    ----------
+    t_concat : array_like
+        Concatenated times.
+    partlens : DataFrame
+        Info on parts, sorted by time.
+    column : str, optional
+        Column of part starts, 'start' (audio) or 'fstart' (fMRI).
+        The default is 'start'.
+
+    Returns
+    -------
+    inds : ndarray
+        Positions (rows of partlens) of the parts, same shape as t_concat.
+
+    """
+
+    starts = partlens[column].to_numpy()
+    inds = np.searchsorted(starts, np.asarray(t_concat), side='left') - 1
+
+    return np.clip(inds, 0, len(starts)-1)
+
+
+def _part_rows(parts, partlens):
+    """ Positions of part numbers in partlens """
+    inds = pd.Index(partlens['part']).get_indexer(np.ravel(parts))
+    if (inds < 0).any():
+        raise ValueError(f'Unknown parts: {np.unique(np.ravel(parts)[inds < 0])}')
+    return inds.reshape(np.shape(parts))
+
+
+def to_concat(t, parts, partlens, column='start'):
+    """
+    Part-wise times to concatenated times
+
+    Parameters
+    ----------
+    t : array_like or Series
+        Part-wise times.
+    parts : array_like
+        Part number of each time.
+    partlens : DataFrame
+        Info on parts.
+    column : str, optional
+        Column of part starts, 'start' (audio) or 'fstart' (fMRI).
+        The default is 'start'.
+
+    Returns
+    -------
+    t_concat : ndarray or Series
+        Concatenated times (a Series with the same index if t is one).
+
+    """
+
+    starts = partlens[column].to_numpy()
+    t_concat = np.asarray(t) + starts[_part_rows(parts, partlens)]
+
+    if isinstance(t, pd.Series):
+        t_concat = pd.Series(t_concat, index=t.index)
+
+    return t_concat
+
+
+def to_part(t_concat, partlens, column='start'):
+    """
+    Concatenated times to part-wise times
+
+    Parameters
+    ----------
+    t_concat : array_like
+        Concatenated times.
+    partlens : DataFrame
+        Info on parts.
+    column : str, optional
+        Column of part starts, 'start' (audio) or 'fstart' (fMRI).
+        The default is 'start'.
+
+    Returns
+    -------
+    parts : ndarray
+        Part number of each time.
+    t : ndarray
+        Part-wise times.
+
+    """
+
+    inds = part_index(t_concat, partlens, column)
+    parts = partlens['part'].to_numpy()[inds]
+    t = np.asarray(t_concat) - partlens[column].to_numpy()[inds]
+
+    return parts, t
+
+
+def audio_to_fmri(t_concat, partlens, offset=fmri_offset):
+    """
+    Audio concat times to fMRI concat times
+
+    Parameters
+    ----------
+    t_concat : array_like
+        Audio concatenated times (e.g. bounds x N perms).
+    partlens : DataFrame
+        Info on parts.
+    offset : float, optional
+        Lag of fMRI time. The default is fmri_offset (1 sec).
+
+    Returns
+    -------
+    ft_concat : ndarray
+        fMRI concatenated times, same shape.
+
+    """
+
+    inds = part_index(t_concat, partlens, 'start')
+    shift = partlens['fstart'].to_numpy() - partlens['start'].to_numpy()
+
+    return np.asarray(t_concat) + shift[inds] - offset
+
+
+def fmri_to_audio(ft_concat, partlens, offset=fmri_offset):
+    """
+    fMRI concat times to audio concat times
+
+    Parameters
+    ----------
+    ft_concat : array_like
+        fMRI concatenated times.
+    partlens : DataFrame
+        Info on parts.
+    offset : float, optional
+        Lag of fMRI time. The default is fmri_offset (1 sec).
+
+    Returns
+    -------
+    t_concat : ndarray
+        Audio concatenated times, same shape.
+
+    """
+
+    inds = part_index(ft_concat, partlens, 'fstart')
+    shift = partlens['start'].to_numpy() - partlens['fstart'].to_numpy()
+
+    return np.asarray(ft_concat) + shift[inds] + offset
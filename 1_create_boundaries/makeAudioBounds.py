@@ -13,6 +13,7 @@ import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from evseg import combine
 
 #datadir = '/m/nbe/scratch/alex/private/jenni/eventseg/segmentdata'
 datadir = '/Users/jenska/code/python/eventcode/1_create_boundaries/out'
@@ -47,37 +48,34 @@ plt.show()
 # search both directions. How much leeway should we give? I guess we should consider
 # the slowness of BOLD response – perhaps ±2 secs is reasonable
 #%% Define parameters and find gaps
+# Each bound goes to the nearest gap within win (distance to the gap, 0 inside);
+# gaps passed over in favour of a nearer one are dropped from both sets
 win = 2
 
-df_bounds['gap_id'] = None
-drop_inds = []
-for i in df_bounds.index:
-    frt = df_bounds['frt_concat'][i]
-    
-    # largen the gaps with win and see if bound fits inside
-    gs = df_gaps.query('off_frt_concat-@win < @frt & @frt < on_frt_concat+@win').index
-    if not gs.empty:
-        df_bounds.loc[i,'gap_id'] = gs[0]
-        
-        # for two gaps select the closest one, drop other:
-        if len(gs)==2:
-            print(f'Two gaps for index {i}')
-            d_0 = df_gaps.loc[gs[0],'on_frt_concat'] - frt
-            d_1 = frt - df_gaps.loc[gs[1],'off_frt_concat']
-            if d_0 < d_1:
-                df_bounds.loc[i,'gap_id'] = gs[0]
-                drop_inds.append(gs[1])
-            else:
-                df_bounds.loc[i,'gap_id'] = gs[1]
-                drop_inds.append(gs[0])
-        
-        # this shouldn't happen:
-        elif len(gs)>2:
-            print(f'Too many gaps! Check index {i}')
-                
-print(df_bounds[~df_bounds['gap_id'].isna()].count()[0])
+inds, dist, ncand = combine.match_gaps(df_bounds['frt_concat'], df_gaps['off_frt_concat'],
+                                       df_gaps['on_frt_concat'], win)
+df_bounds['gap_id'] = np.where(inds >= 0, df_gaps.index[inds], np.nan)
+
+# the other gaps within win of a matched bound
+lo = np.searchsorted(df_gaps['on_frt_concat'] + win, df_bounds['frt_concat'], side='right')
+drop_inds = sorted({df_gaps.index[g] for (l,n) in zip(lo, ncand) if n > 1
+                    for g in range(l, l+n) if g not in inds})
+
+print(f'Two or more gaps for indices {list(np.flatnonzero(ncand > 1))}')
+print(df_bounds['gap_id'].notna().sum())
 print(drop_inds)
-del(d_0,d_1,frt,i,gs)
+del(inds,dist,ncand,lo)
+
+#%% How many sham boundaries coincide with gaps (same rule, all perms at once)
+perms = np.load(os.path.join(datadir,'perms_f3s.npy'))
+pinds, _, _ = combine.match_gaps(perms, df_gaps['off_frt_concat'],
+                                 df_gaps['on_frt_concat'], win)
+nmatch = (pinds >= 0).sum(axis=0)
+print(f'Perms: {nmatch.mean()} +- {nmatch.std()} of {len(perms)} at a gap')
+plt.hist(nmatch, bins=30)
+plt.axvline(df_bounds['gap_id'].notna().sum(), c='r')
+plt.show()
+
 #%% Make boundgaps
 
 # We'll use the middle of the gap as the timing
@@ -98,25 +96,17 @@ df_gapbound.to_csv(os.path.join(datadir,'audiobounds_f3s.csv'))
 
 #%% Create permgaps
 # Randomly sample same amount of non-bound gaps for 1000 sets, segment len > 6
-# Would've liked to use seglen=10, but that gets pretty tricky
+# Sampled directly from the valid sets (no rejection), so seglen=10 or 10k
+# sets are no problem either; seeded so the sets can be recreated
 
 # Sample the gaps
 nbound = len(df_gapbound)
 nperm = 1000
 seglen = 6
-arr_sample = np.zeros([nbound,nperm])
-
-i = 0
-k = 0
-while i < nperm:
-    sample = df_gapother.sample(nbound)
-    sample.sort_index(inplace=True)
-    if sample['frt_concat'].diff().abs().min() > seglen:
-        arr_sample[:,i] = sample['frt_concat']
-        i = i+1
-    k = k+1
-
-print(k)
+seed = 20210826
+
+inds = combine.sample_spaced(df_gapother['frt_concat'], nbound, seglen, n=nperm, seed=seed)
+arr_sample = df_gapother['frt_concat'].to_numpy()[inds]
 
 #%% Do we have identical perms
 from scipy.spatial.distance import pdist, squareform
@@ -4,16 +4,19 @@
 EVENTSEGMENTATION helper
 Calculating and saving the envelopes
 
+Streams each WAV in blocks (evseg.audio), so memory stays constant regardless
+of chapter length and all parts can be run in one go. The feature bank reads
+each WAV once for all features and rates, and the 10 Hz envelope .npy files
+are written from it.
+
 @author: saarisj2
 """
 from os.path import join
 from time import time
-import gc
 import resource
 import numpy as np
 
-from scipy.io.wavfile import read
-from scipy.signal import hilbert, decimate
+from evseg import audio
 
 audiodir = '/m/nbe/scratch/alex/stimuli/wav/concatenated_story'
 
@@ -23,49 +26,25 @@ def mem_use():
     print(f'Memory usage:  {muse} MB')
 mem_use()
 
-#%% To battle memory leaks we have to define a generator for the actual work
-# Not that it helps, really...
-
-gc.set_threshold(100)
-
-def save_envelope(parts, d):
-    audio = []
-    envelope = []
-    denv = []
-    
-    for p in parts:
-        print(f'Extracting part {p}...')
-        srate, audio = read(join(audiodir, f'kappale{p}.wav'))
-        print(f'Length of part: {len(audio)/srate/60} min')
-        
-        # Extract and decimate envelope to 10Hz
-        tic = time()
-        envelope = np.array(abs(hilbert(audio)))
-        denv = np.array(decimate(envelope, round(srate/d), ftype='fir'))
-        mem_use()
-        print(gc.get_count())
-        
-        # Save
-        fname = f'kappale{p}_envelope_{d}Hz.npy'
-        np.save(join(audiodir, fname), denv, allow_pickle=False)
-        print(f'Saved envelope as {fname}.')
-        
-        toc = time()
-        print(f'Took {toc-tic} seconds.\n')
-        
-        yield 0
+#%% Feature bank: all features at all rates in one pass over the WAVs
 
-#%% Exctract and save envelopes
-# In parts, as there's still some memory leak I can't pinpoint :(
+d = 10 # final srate of the legacy envelope files, Hz
+parts = list(range(1,11))
 
-d = 10 # final srate of envelope, Hz
-part1 = list(range(1,5))
-part2 = list(range(5,9))
-part3 = list(range(9,11))
+bankfile = 'audiofeatures.npy' # + .json index
+rates = [10, 1]                # Hz: envelope rate and TR-rate
+bands = [(100, 1000), (1000, 4000)] # Hz, band-limited envelopes
 
+tic = time()
+wavs = {p: join(audiodir, f'kappale{p}.wav') for p in parts}
+audio.save_bank(wavs, join(audiodir, bankfile), rates, bands)
+print(f'Saved feature bank as {bankfile}, took {time()-tic} seconds.')
 mem_use()
-re = [r for r in save_envelope(part3, d)]
-gc.collect()
-mem_use()
 
-#%%
\ No newline at end of file
+#%% Also the old 10 Hz envelope files, straight from the bank
+bank = audio.load_bank(join(audiodir, bankfile))
+for p in parts:
+    denv = audio.query_bank(bank, p, d)
+    np.save(join(audiodir, f'kappale{p}_envelope_{d}Hz.npy'), denv, allow_pickle=False)
+
+#%%
@@ -9,6 +9,7 @@ fix the audio gaps into fMRI time
 
 import os
 import pandas as pd
+from evseg import timeline
 
 datadir = '/Users/jenska/code/python/eventsegment/segment_data/behavioral_ratings_data/out'
 gapfile = 'all_audiogaps.csv'
@@ -31,10 +32,9 @@ df_fgaps['on_frt'] = df_fgaps['off_frt'] + df_fgaps['gap_dur']
 print(df_fgaps)
 
 #%% Calc concat times
-for i in df_parts.index:
-    inds = df_fgaps.query('part == @df_parts.part[@i]').index
-    df_fgaps.loc[inds,'off_frt_concat'] = df_fgaps.off_frt[inds] + df_parts.fstart[i]
-    df_fgaps.loc[inds,'on_frt_concat'] = df_fgaps.on_frt[inds] + df_parts.fstart[i]
+for col in ['off_frt', 'on_frt']:
+    df_fgaps[col+'_concat'] = timeline.to_concat(df_fgaps[col], df_fgaps['part'],
+                                                 df_parts, column='fstart')
 print(df_fgaps)
 
 #%% Save
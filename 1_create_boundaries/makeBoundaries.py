@@ -12,7 +12,7 @@ Make final boundaries set
 import os
 import pandas as pd
 import numpy as np
-from evseg import combine, boundplot
+from evseg import combine, boundplot, timeline
 import matplotlib.pyplot as plt
 
 datadir = '/Users/jenska/code/python/eventsegment/segment_data/behavioral_ratings_data/flat'
@@ -43,11 +43,7 @@ inds = df_concat.query('rt < 0').index
 df_concat.loc[inds, 'rt'] = 0
 
 #%% Add concatenated rts
-df_concat['rt_concat'] = 0
-for i in df_parts.index:
-    p = df_parts.part[i]
-    ind = df.query('part == @p').index
-    df_concat.loc[ind, 'rt_concat'] = df_concat.loc[ind, 'rt'] + df_parts.start[i]
+df_concat['rt_concat'] = timeline.to_concat(df_concat['rt'], df_concat['part'], df_parts)
 
 #%% Save this dataset (if we need to checkParams again)
 df_concat.to_csv(os.path.join(datadir,'segment_data_concat.csv'))
@@ -92,7 +88,7 @@ print(min(segs))
 print(max(segs))
 plt.hist(segs, bins=50)
 
-del(i,ind,inds,fig,this_seg,p)
+del(i,inds,fig,this_seg,p)
 #%%
 
 #%% -----------------  POST-CHAINING ADJUSTMENTS  -------------------------
@@ -173,10 +169,8 @@ print(len(df_fbounds))
 # we're left with 79 bounds
 
 # Also create the frt_concat while we're at it
-df_fbounds['frt_concat'] = 0
-for p in df_parts.part:
-    inds = df_fbounds.query('part == @p').index
-    df_fbounds.loc[inds,'frt_concat'] = df_fbounds['frt'] + df_parts.fstart[p-1]
+df_fbounds['frt_concat'] = timeline.to_concat(df_fbounds['frt'], df_fbounds['part'],
+                                             df_parts, column='fstart')
 print(df_fbounds)
 
 #%% Save bounds
@@ -13,7 +13,7 @@ import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from evseg import combine
+from evseg import combine, timeline
 
 dataroot = '/Users/jenska/code/python/eventcode/'
 outdir = os.path.join(dataroot,'1_create_boundaries/out')
@@ -44,7 +44,9 @@ plt.ylabel('count')
 plt.show()
 
 #%% Create permuted boundaries from segments
-perms = combine.make_permutations(segs, n=1000)
+# Seeded, so that the perms can be recreated
+seed = 20210818
+perms = combine.make_permutations(segs, n=1000, seed=seed)
 
 #%% Plot all to check randomness
 lines = np.vstack([np.ones(len(perms))*i for i in range(1000)]).T
@@ -59,22 +61,9 @@ np.save(os.path.join(outdir, f'perms_meg_{react_time}.npy'), perms, allow_pickle
 time to be readily used in the design matrices. We also remove the 1 sec fMRI
 offset, though it's not strictly necessary.
 """
-N = perms.shape[1]
-perms_frtcat = np.zeros_like(perms)
-for i in range(N):
-    
-    these_perms = perms[:,i]
-    perms_frtcat[:,i] = these_perms
-    
-    # Calculate the base frt_concat
-    for j in range(1,len(df_parts)):
-        mask = these_perms > df_parts.start[j]
-        perms_frtcat[mask,i] = these_perms[mask] - df_parts.start[j] + df_parts.fstart[j]
-    
-    # Remove the 1 sec fMRI offset
-    perms_frtcat[:,i] = perms_frtcat[:,i] - 1
-        
-del(i,j)
+# Map all perms at once (this also removes the 1 sec fMRI offset)
+perms_frtcat = timeline.audio_to_fmri(perms, df_parts)
+
 #%% Plot all to check shift
 lines = np.vstack([np.ones(len(perms_frtcat))*i for i in range(1000)]).T
 plt.scatter(perms_frtcat, lines, s=1, c='r')
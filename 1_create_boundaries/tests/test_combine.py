@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION
+Regression tests for evseg.combine.chain_concat
+
+@notes:   python -m pytest 1_create_boundaries/tests
+"""
+
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from evseg import combine, sweep
+
+partlens = pd.DataFrame({'part': [1, 2], 'len': [100., 100.], 'start': [0., 100.]})
+fincols = ['id','part','rt','rt_concat','clen','nobs']
+
+
+def test_chain_concat_sparse():
+    # no 1st level cluster with more than one annotation
+    df = pd.DataFrame({'subj': [1, 2, 3], 'rt_concat': [10., 50., 150.]})
+    dffin, df2nd = combine.chain_concat(df, partlens, 2, 4)
+    assert list(dffin.columns) == fincols and dffin.empty
+    assert df2nd.empty and 'cluster2_id' in df2nd.columns
+
+
+def test_chain_concat_empty():
+    df = pd.DataFrame({'subj': [], 'rt_concat': []})
+    dffin, df2nd = combine.chain_concat(df, partlens, 2, 4)
+    assert list(dffin.columns) == fincols and dffin.empty
+    assert df2nd.empty
+
+
+def test_chain_concat_bounds():
+    df = pd.DataFrame({'subj': [1, 2, 1, 3, 2], 'rt_concat': [10., 11., 11.5, 120., 121.]})
+    dffin, _ = combine.chain_concat(df, partlens, 2, 4)
+    assert dffin['part'].tolist() == [1, 2]
+    assert dffin['nobs'].tolist() == [2, 2]       # subject 1 averaged into one
+    assert dffin['rt'].iloc[1] == 20.5
+
+
+def test_sweep_sparse_cell():
+    # a sparse (react_time, win1, win2) cell must not take down the sweep
+    df = pd.DataFrame({'subj': [1, 2, 3, 1, 2], 'part': [1, 1, 1, 2, 2],
+                       'rt': [10., 11., 50., 20., 21.5]})
+    df_sweep = sweep.sweep_params(df, partlens, [0], [0.5, 2], [4], [0, 1], n_jobs=1)
+    assert len(df_sweep) == 4
+    assert df_sweep.query('win1 == 0.5')['nbounds'].eq(0).all()
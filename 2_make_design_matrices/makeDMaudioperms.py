@@ -10,22 +10,31 @@ Make design matrices for bounds and perms
 """
 
 from os.path import join
+import sys
 import pandas as pd
 import numpy as np
 
 from nilearn import plotting
 from nilearn.glm import first_level
+from nilearn.glm.first_level import glover_hrf
 
 #datadir = '/m/nbe/scratch/alex/private/jenni/eventseg/scripts'
 dataroot = '/Users/jenska/code/python/eventcode'
 indir = join(dataroot,'1_create_boundaries/out')
 outdir = join(dataroot,'2_make_design_matrices/out')
 
+sys.path.append(join(dataroot,'1_create_boundaries'))
+from evseg import audio, timeline
+sys.path.append(join(dataroot,'2_make_design_matrices'))
+from permDM import makePermDM, savePermDM
+
 react_time = '3s'
 boundfile = f'audiobounds_f{react_time}.csv'
 permfile = f'audioperms_f{react_time}.npy'
 boundout = f'dm_audiobounds_{react_time}.csv'
-permout = f'dm_audioperms_{react_time}.csv'
+permout = f'dm_audioperms_{react_time}.npy' # + .json column index
+bankfile = '/m/nbe/scratch/alex/stimuli/wav/concatenated_story/audiofeatures.npy'
+envout = 'dm_envelope.csv'
 
 #%% Get boundaries and make DM
 
@@ -34,7 +43,7 @@ df_bounds['frt'] = df_bounds['on_frt'] - df_bounds['gap_dur']/2  # add frt
 df_parts = pd.read_csv(join(indir,'partlensf.csv'),index_col=0)
 
 # Make boundary dm run-by-run
-dm = pd.DataFrame()
+dms = []
 for i in df_parts.index:
     times = np.arange(df_parts.flen[i]) # fmri times
     
@@ -47,7 +56,8 @@ for i in df_parts.index:
     this_dm = first_level.make_first_level_design_matrix(times, events,
                           drift_model='polynomial', drift_order=3)
     this_dm['constant'] = i
-    dm = dm.append(this_dm, ignore_index=True)
+    dms.append(this_dm)
+dm = pd.concat(dms, ignore_index=True)
 
 # plot design (or part of it)
 plotting.plot_design_matrix(dm)
@@ -64,31 +74,44 @@ and the constants for runind. The perms then line up with those.
 # These are already frt_concat
 perms = np.load(join(indir, permfile))
 
-# To get a regressor for each perm we need to code them as trial types
-df_perms = pd.DataFrame()
-p = pd.DataFrame()
-
-for i in range(perms.shape[1]):
-    p['onset'] = perms[:,i]
-    p['duration'] = 0
-    p['trial_type'] = i
-    df_perms = df_perms.append(p, ignore_index=True)
-
-df_perms.sort_values(by='onset', inplace=True, ignore_index=True)
-
-#%%
-# Create DM, hello slow
+# One regressor per perm, all convolved in one vectorized pass (same as
+# nilearn's make_first_level_design_matrix with one trial type per perm)
 times = np.arange(df_parts.flen.sum())
-dm_perm = first_level.make_first_level_design_matrix(times, df_perms,
-                          drift_model=None)
+dm_perm = makePermDM(times, perms)
 
 #%% Plot a random dm
 p = 30
-#print(df_perms.query('trial_type == @p'))
+#print(perms[:,p])
 #plotting.plot_design_matrix(dm_perm.loc[:,p:p+1])
 plotting.plot_design_matrix(dm_perm.loc[:,50:80])
 
 #%% Save perm dm
-dm_perm.to_csv(join(outdir,permout)) # around 55 MB
+savePermDM(dm_perm, join(outdir,permout))
+
+# Left in the constant, much too scared of crashing everything...
+
+#%% Make DM of the audio envelope (example of querying the feature bank)
+# TR-rate broadband envelope straight from the feature bank; fMRI time t of a
+# part is audio time t + fmri_offset. The audio ends before the last volumes
+# of a part, so the (demeaned) envelope is zero-padded to the fMRI length.
+# Convolved with the HRF, drifts and run constants as in the boundary DM,
+# envelope as the first column.
+bank = audio.load_bank(bankfile)
+dms = []
+for i in df_parts.index:
+    times = np.arange(df_parts.flen[i]) # fmri times
+    start = timeline.fmri_offset
+    env = audio.query_bank(bank, df_parts.part[i], 1, start, start+len(times))
+    env = np.pad(env - env.mean(), (0, len(times)-len(env)))
+    assert len(env) == len(times)
+    env = np.convolve(env, glover_hrf(1., 1))[:len(times)]
+    
+    this_dm = first_level.make_first_level_design_matrix(times, None,
+                          drift_model='polynomial', drift_order=3,
+                          add_regs=env[:,np.newaxis], add_reg_names=['envelope'])
+    this_dm['constant'] = i
+    dms.append(this_dm)
+dm_env = pd.concat(dms, ignore_index=True)
 
-# Left in the constant, much too scared of crashing everything...
\ No newline at end of file
+plotting.plot_design_matrix(dm_env)
+dm_env.to_csv(join(outdir,envout))
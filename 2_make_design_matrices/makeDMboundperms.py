@@ -10,6 +10,7 @@ Make design matrices for bounds and perms
 """
 
 from os.path import join
+import sys
 import pandas as pd
 import numpy as np
 
@@ -21,11 +22,15 @@ dataroot = '/Users/jenska/code/python/eventcode'
 indir = join(dataroot,'1_create_boundaries/out')
 outdir = join(dataroot,'2_make_design_matrices/out')
 
+sys.path.append(join(dataroot,'1_create_boundaries'))
+sys.path.append(join(dataroot,'2_make_design_matrices'))
+from permDM import makePermDM, savePermDM
+
 react_time = '3s'
 boundfile = f'boundaries_f{react_time}.csv'
 permfile = f'perms_f{react_time}.npy'
 boundout = f'dm_bounds_{react_time}.csv'
-permout = f'dm_perms_{react_time}.csv'
+permout = f'dm_perms_{react_time}.npy' # + .json column index
 
 #%% Get boundaries and make DM
 
@@ -33,7 +38,7 @@ df_bounds = pd.read_csv(join(indir,boundfile),index_col=0)
 df_parts = pd.read_csv(join(indir,'partlensf.csv'),index_col=0)
 
 # Make boundary dm run-by-run
-dm = pd.DataFrame()
+dms = []
 for i in df_parts.index:
     times = np.arange(df_parts.flen[i]) # fmri times
     
@@ -46,7 +51,8 @@ for i in df_parts.index:
     this_dm = first_level.make_first_level_design_matrix(times, events,
                           drift_model='polynomial', drift_order=3)
     this_dm['constant'] = i
-    dm = dm.append(this_dm, ignore_index=True)
+    dms.append(this_dm)
+dm = pd.concat(dms, ignore_index=True)
 
 # plot design (or part of it)
 plotting.plot_design_matrix(dm)
@@ -63,31 +69,18 @@ and the constants for runind. The perms then line up with those.
 # These are already frt_concat
 perms = np.load(join(indir, permfile))
 
-# To get a regressor for each perm we need to code them as trial types
-df_perms = pd.DataFrame()
-p = pd.DataFrame()
-
-for i in range(perms.shape[1]):
-    p['onset'] = perms[:,i]
-    p['duration'] = 0
-    p['trial_type'] = i
-    df_perms = df_perms.append(p, ignore_index=True)
-
-df_perms.sort_values(by='onset', inplace=True, ignore_index=True)
-
-#%%
-# Create DM, hello slow
+# One regressor per perm, all convolved in one vectorized pass (same as
+# nilearn's make_first_level_design_matrix with one trial type per perm)
 times = np.arange(df_parts.flen.sum())
-dm_perm = first_level.make_first_level_design_matrix(times, df_perms,
-                          drift_model=None)
+dm_perm = makePermDM(times, perms)
 
 #%% Plot a random dm
 p = 30
-print(df_perms.query('trial_type == @p'))
+print(perms[:,p])
 plotting.plot_design_matrix(dm_perm.loc[:,p:p+1])
 #plotting.plot_design_matrix(dm_perm.loc[:,50:100])
 
 #%% Save perm dm
-dm_perm.to_csv(join(outdir,permout)) # around 55 MB
+savePermDM(dm_perm, join(outdir,permout))
 
 # Left in the constant, much too scared of crashing everything...
\ No newline at end of file
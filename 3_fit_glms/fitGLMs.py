@@ -10,63 +10,164 @@ fitting all the GLMs
 """
 
 import os
+import sys
+import time
 import pandas as pd
 import numpy as np
-from statsmodels.api import OLS
+from scipy import stats
+
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.results import ResultBuffer
+from evseg.binstore import load_binary
+from evseg.roiextract import clean_tcs
 
 # Global locations
 rootdir = '/m/nbe/scratch/alex/private/jenni/eventseg'
 savedir = os.path.join(rootdir, 'fmri-data','ini-roi')
 dmdir = os.path.join(rootdir, 'scripts/2_make_design_matrices/out')
 
-# Basic fitting of bounds and perms -- CHECKED
-def fitPerms(df_roi, joblog, dmfile, permfile, areas=None):
+# OLS of one design X against many targets (columns of Y, i.e. areas) at once.
+# X is the same for every area, so its pseudo-inverse is computed only once.
+# Optional contrasts (rows of weights over the columns of X) are estimated
+# as well and appended after the regressors. Same estimates as statsmodels OLS
+# and its t_test. Returns params, bse, t and p as (regressors x areas) arrays.
+def multiOLS(Y, X, contrasts=None):
 
-    dmpath = os.path.join(dmdir,dmfile)
-    permpath = os.path.join(dmdir,permfile)
+    Y = np.asarray(Y, dtype=float)
+    X = np.asarray(X, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:,np.newaxis]
 
-    df_dm = pd.read_csv(dmpath, index_col=0)
-    df_perms = pd.read_csv(permpath, index_col=0)
-    
-    # DM with constants (wide)
-    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run')
+    # One factorization for all areas
+    Xpinv = np.linalg.pinv(X)
+    params = Xpinv @ Y
+    cov = Xpinv @ Xpinv.T    # normalized covariance of params
 
-    # DF for all betas
-    df_betas = pd.DataFrame(columns=['perm','beta','se','p','area'])
+    # Residual variance per area
+    resid = Y - X @ params
+    df_resid = len(Y) - np.linalg.matrix_rank(X)
+    scale = np.einsum('ij,ij->j', resid, resid) / df_resid
+
+    # Regressors themselves and then the contrasts
+    L = np.eye(X.shape[1])
+    if contrasts is not None:
+        L = np.vstack((L, np.atleast_2d(contrasts)))
+    params = L @ params
+    var = np.einsum('ij,jk,ik->i', L, cov, L)
+
+    bse = np.sqrt(var[:,np.newaxis] * scale[np.newaxis,:])
+    t = params / bse
+    p = 2 * stats.t.sf(np.abs(t), df_resid)
+
+    return params, bse, t, p
+
+# Nuisance projection for batchOLS: the regressors of interest (columns of R)
+# with the nuisance design Z (drifts & run constants) projected out, their sums
+# of squares and the residual dofs of the full model [r, Z]. Computed once, it
+# can be reused for any number of targets (e.g. for every chunk of areas).
+def projectDesign(R, Z):
+
+    R = np.asarray(R, dtype=float)
+    Z = np.asarray(Z, dtype=float)
+    if R.ndim == 1:
+        R = R[:,np.newaxis]
+
+    # Residualize against the nuisance part (same pinv as statsmodels)
+    Zpinv = np.linalg.pinv(Z)
+    Rr = R - Z @ (Zpinv @ R)
+
+    return {'Z': Z, 'Zpinv': Zpinv, 'Rr': Rr,
+            'sxx': np.einsum('ij,ij->j', Rr, Rr)[:,np.newaxis],    # regs x 1
+            'df_resid': len(Z) - np.linalg.matrix_rank(Z) - 1}
+
+# Closed-form OLS for a batch of alternative regressors of interest (columns
+# of R) that share the same nuisance design Z (drifts & run constants).
+# Following Frisch-Waugh-Lovell, Z is projected out of both Y and R once, after
+# which each (regressor, area) pair is a simple regression. Gives the same
+# beta, se and p as fitting OLS(y, [r, Z]) separately for every pair.
+# The projection of R can be passed in as proj (from projectDesign) instead.
+# Returns beta, se and p as (regressors x areas) arrays.
+def batchOLS(Y, R=None, Z=None, proj=None):
+
+    if proj is None:
+        proj = projectDesign(R, Z)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:,np.newaxis]
+
+    Yr = Y - proj['Z'] @ (proj['Zpinv'] @ Y)
+    df_resid, sxx = proj['df_resid'], proj['sxx']
+
+    # Sums of squares and cross products
+    syy = np.einsum('ij,ij->j', Yr, Yr)[np.newaxis,:]    # 1 x areas
+    sxy = proj['Rr'].T @ Yr                               # regs x areas
+
+    beta = sxy / sxx
+    rss = syy - beta * sxy
+    se = np.sqrt(rss / df_resid / sxx)
+    p = 2 * stats.t.sf(np.abs(beta / se), df_resid)
+
+    return beta, se, p
+
+# Perm design matrix, either from the binary store (.npy, memory-mapped and
+# shared by all jobs on the node) or from the old CSV.
+# Returns the perm regressors (TR x perms) and their column names.
+def loadPerms(permpath):
+
+    if permpath.endswith('.npy'):
+        arr, index = load_binary(permpath, mmap_mode='r')
+        cols = pd.Index(index['columns'])
+    else:
+        df_perms = pd.read_csv(permpath, index_col=0)
+        arr = df_perms.to_numpy()
+        cols = df_perms.columns
+
+    # the last column of the perm DM is the constant
+    return arr[:,:-1], cols[:-1]
+
+# Design of fitPerms: the bounds (perm 0) and the perms as one block of
+# regressors, projected against the drifts & run constants once (projectDesign),
+# so that fitting the areas chunk by chunk reads and projects the perm DM only
+# once per subject. Returns the perm numbers and the projection.
+def permDesign(dmfile, permfile):
+
+    df_dm = pd.read_csv(os.path.join(dmdir,dmfile), index_col=0)
+    P, cols = loadPerms(os.path.join(dmdir,permfile))
+
+    # DM with constants (wide), regressors of interest: bounds first, then perms
+    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run', dtype=float)
+    Z = X.drop(columns='bound').to_numpy()
+    R = np.column_stack([X['bound'].to_numpy(), P])
+    perms = np.append(0, cols.astype(int)+1)
+
+    return perms, projectDesign(R, Z)
+
+# Basic fitting of bounds and perms -- CHECKED
+# (design from permDesign, if already made for this subject)
+def fitPerms(df_roi, joblog, dmfile, permfile, areas=None, design=None):
+
+    if design is None:
+        design = permDesign(dmfile, permfile)
+    perms, proj = design
     
     if areas is None:
         areas = df_roi.columns[:-1]
     
-    # Loop thru areas, gather betas and append to df
-    for area in areas:
-
-        # This area = y
-        joblog.write('Fitting GLMs for ' + area + '...\n')
-        y = df_roi[area]
-        X['bound'] = df_dm['bound'] # restore original bounds
-        res = OLS(y, X).fit()
-
-        # Save betas from bounds
-        betas = pd.DataFrame(columns=['perm','beta','p','se','area'])
-        betas = betas.append({'perm':0,
-                              'beta':res.params[0],
-                              'se':res.bse[0],
-                              'p':res.pvalues[0]}, ignore_index=True)
-
-        # Save betas from perms
-        for c in df_perms.columns[:-1]:
-            X['bound'] = df_perms[c]
-            res = OLS(y, X).fit()
-            betas = betas.append({'perm': int(c)+1,
-                                  'beta':res.params[0],
-                                  'se':res.bse[0],
-                                  'p':res.pvalues[0]}, ignore_index=True)
-
-        # Append to df
-        betas['area'] = area
-        df_betas = df_betas.append(betas, ignore_index=True)
-
-        joblog.write('Done.\n')
+    # Fit all bounds/perms for all areas in one go
+    joblog.write(f'Fitting GLMs for {len(areas)} areas x {len(perms)} sets...\n')
+    beta, se, p = batchOLS(df_roi[areas].to_numpy(dtype=float), proj=proj)
+    
+    # DF for all betas (area by area, perms in order)
+    buf = ResultBuffer({'perm': int, 'beta': float, 'se': float, 'p': float,
+                        'area': object}, len(areas)*len(perms))
+    buf.add(perm=np.tile(perms, len(areas)), beta=beta.ravel(order='F'),
+            se=se.ravel(order='F'), p=p.ravel(order='F'),
+            area=np.repeat(np.asarray(areas, dtype=object), len(perms)))
+    df_betas = buf.to_frame()
+    
+    joblog.write('Done.\n')
         
     if df_betas.isnull().values.any():
         joblog.write('ERROR: Resulted in nans. Aborting.\n')
@@ -74,6 +175,53 @@ def fitPerms(df_roi, joblog, dmfile, permfile, areas=None):
 
     return df_betas
 
+# Voxelwise bounds vs perms. The voxel time courses (TR x voxels, e.g. a memory
+# map of raw tcs) are cleaned like the ROIs and fitted a chunk of voxels at a
+# time, so memory is set by chunk x (TRs + perms), not by the number of voxels.
+# Same fit as batchOLS (and fitPerms) with the design of permDesign, but only
+# the bound gets se and p.
+# Returns a dict of per-voxel arrays: beta, se, p (of the bounds), permp (share
+# of perms with beta >= the bound beta, bound counted in). The perm betas
+# go into perm_betas (voxels x perms, e.g. a memory map) if given.
+def fitPermsVoxels(tcs, runind, joblog, dmfile, permfile, chunk=2000,
+                   order=1, scale='zscore', perm_betas=None):
+
+    # Bound & perm regressors residualized against the nuisance part once
+    perms, proj = permDesign(dmfile, permfile)
+    Z, Zpinv, Rr, sxx, df_resid = [proj[k] for k in ['Z','Zpinv','Rr','sxx','df_resid']]
+    
+    nvox, nperm = tcs.shape[1], len(perms)-1
+    res = {k: np.empty(nvox) for k in ['beta','se','p','permp']}
+    
+    joblog.write(f'Fitting GLMs for {nvox} voxels x {nperm+1} sets, {chunk} voxels at a time...\n')
+    tic = time.time()
+    for c0 in range(0, nvox, chunk):
+        c1 = min(c0+chunk, nvox)
+        
+        # Clean (per run) and fit all bounds/perms for this chunk
+        Y = clean_tcs(tcs[:,c0:c1], runind, order, scale)
+        Yr = Y - Z @ (Zpinv @ Y)
+        sxy = Rr.T @ Yr
+        beta = sxy / sxx
+        
+        rss = np.einsum('ij,ij->j', Yr, Yr) - beta[0] * sxy[0]
+        res['beta'][c0:c1] = beta[0]
+        res['se'][c0:c1] = np.sqrt(rss / df_resid / sxx[0])
+        res['permp'][c0:c1] = (1 + (beta[1:] >= beta[0]).sum(axis=0)) / (1 + nperm)
+        if perm_betas is not None:
+            perm_betas[c0:c1] = beta[1:].T
+    
+    res['p'] = 2 * stats.t.sf(np.abs(res['beta'] / res['se']), df_resid)
+    
+    toc = time.time()
+    joblog.write(f'Done in {toc-tic:.1f} s: {nvox*(nperm+1) / (toc-tic):.3g} voxel-permutations/sec.\n')
+    
+    if np.isnan(res['beta']).any():
+        joblog.write('ERROR: Resulted in nans. Aborting.\n')
+        raise Exception('ERROR: Resulted in nans, no betas returned.')
+    
+    return res
+
 # Fit bounds and controls, take contrast as well
 def fitControl(df_roi, joblog, dmfile, areas=None):
 
@@ -81,45 +229,32 @@ def fitControl(df_roi, joblog, dmfile, areas=None):
     df_dm = pd.read_csv(dmpath, index_col=0)
     
     # DM with constants (wide)
-    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run')
+    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run', dtype=float)
     contrast = np.zeros(X.shape[1])
     contrast[X.columns.get_loc('bound')] = 1
     contrast[X.columns.get_loc('control')] = -1
     
     joblog.write(f'Contrast is {contrast}, with columns {X.columns}.\n')
-
-    # DF for all betas
-    df_betas = pd.DataFrame(columns=['area','bound_beta','bound_se',
-                                     'control_beta','control_se','t','p'])
     
     if areas is None:
         areas = df_roi.columns[:-1]
     
-    # Loop thru areas, gather betas and append to df
-    for area in areas:
-
-        # This area = y
-        joblog.write('Fitting GLMs for ' + area + '...\n')
-        y = df_roi[area]
-        res = OLS(y, X).fit()
-        t_score = res.t_test(contrast)
-
-        # Save betas from bounds
-        betas = pd.DataFrame(columns=['area','bound_beta','bound_se',
-                                     'control_beta','control_se','t','p'])
-        betas = betas.append({'area':area,
-                              'bound_beta':res.params['bound'],
-                              'bound_se':res.bse['bound'],
-                              'control_beta':res.params['control'],
-                              'control_se':res.bse['control'],
-                              't':t_score.tvalue.item(),
-                              'p':t_score.pvalue.item() }, ignore_index=True)
-        # I wonder... am I gonna need all the dfs and stuff later on?
-        
-        # Append to df
-        df_betas = df_betas.append(betas, ignore_index=True)
-
-        joblog.write('Done.\n')
+    # Fit all areas at once, contrast comes as the last row
+    joblog.write(f'Fitting GLMs for {len(areas)} areas...\n')
+    Y = df_roi[areas].to_numpy(dtype=float)
+    params, bse, t, p = multiOLS(Y, X.to_numpy(), contrasts=contrast)
+    
+    # DF for all betas
+    ib = X.columns.get_loc('bound')
+    ic = X.columns.get_loc('control')
+    buf = ResultBuffer({'area': object, 'bound_beta': float, 'bound_se': float,
+                        'control_beta': float, 'control_se': float,
+                        't': float, 'p': float}, len(areas))
+    buf.add(area=np.asarray(areas), bound_beta=params[ib], bound_se=bse[ib],
+            control_beta=params[ic], control_se=bse[ic], t=t[-1], p=p[-1])
+    df_betas = buf.to_frame()
+    
+    joblog.write('Done.\n')
     
     if df_betas.isnull().values.any():
         joblog.write('ERROR: Resulted in nans. Aborting.\n')
@@ -132,9 +267,10 @@ def fitFIR(df_roi, joblog, dmprefix, conds, areas=None):
     
     if areas is None:
         areas = df_roi.columns[:-1]
+    Y = df_roi[areas].to_numpy(dtype=float)
     
-    # DF for all betas
-    df_betas = pd.DataFrame(columns=['regressor','beta','se','cond','area'])
+    # Betas for all conds (sized once we know the number of delays)
+    buf = None
     
     for cond in conds:
         dmfile = f'{dmprefix}_{cond}.csv'
@@ -144,29 +280,30 @@ def fitFIR(df_roi, joblog, dmprefix, conds, areas=None):
         df_dm = pd.read_csv(dmpath, index_col=0)
         
         # Design matrix (with dummy constants)
-        X = pd.get_dummies(df_dm, columns=['constant'], prefix='run')
+        X = pd.get_dummies(df_dm, columns=['constant'], prefix='run', dtype=float)
         
-        # Loop thru areas, gather betas and append to df
-        for area in areas:
-            betas = pd.DataFrame()
-    
-            # This area = y
-            y = df_roi[area]
-            res = OLS(y, X).fit()
-            
-            # Define which regressors we want
-            inds_regs = res.params.index.str.contains('delay')
-            betas['regressor'] = res.params.index[inds_regs]
-    
-            # Save betas from FIR
-            betas['beta'] = res.params[inds_regs].to_numpy()
-            betas['se'] = res.bse[inds_regs].to_numpy()
-            betas['area'] = area
-            betas['cond'] = cond
-            df_betas = df_betas.append(betas, ignore_index=True)
+        # Fit all areas at once
+        params, bse, _, _ = multiOLS(Y, X.to_numpy())
+        
+        # Define which regressors we want
+        inds_regs = X.columns.str.contains('delay')
+        regs = X.columns[inds_regs]
+        
+        # Save betas from FIR (area by area)
+        if buf is None:
+            buf = ResultBuffer({'regressor': object, 'beta': float, 'se': float,
+                                'cond': object, 'area': object},
+                               len(areas)*len(conds)*len(regs))
+        buf.add(regressor=np.tile(regs, len(areas)),
+                beta=params[inds_regs].ravel(order='F'),
+                se=bse[inds_regs].ravel(order='F'), cond=cond,
+                area=np.repeat(np.asarray(areas, dtype=object), len(regs)))
             
         joblog.write('Done.\n')
     
+    # DF for all betas
+    df_betas = buf.to_frame()
+    
     if df_betas.isnull().values.any():
         joblog.write('ERROR: Resulted in nans. Aborting.\n')
         raise Exception('ERROR: Resulted in nans, no betas returned.')
@@ -175,9 +312,6 @@ def fitFIR(df_roi, joblog, dmprefix, conds, areas=None):
 
 # Fitting audio envelope
 def fitAudio(df_roi, joblog, dmfile, areas=None,):
-    
-    # DF for all betas
-    df_betas = pd.DataFrame(columns=['beta','se','p','area'])
 
     joblog.write('Fitting GLMs for ' + dmfile + '...\n')
     
@@ -185,24 +319,20 @@ def fitAudio(df_roi, joblog, dmfile, areas=None,):
     df_dm = pd.read_csv(dmpath, index_col=0)
     
     # Constants from long to wide
-    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run')
+    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run', dtype=float)
     
     if areas is None:
         areas = df_roi.columns[:-1]
     
-    # Loop thru areas, gather betas and append to df
-    for area in areas:
-        
-        y = df_roi[area]
-        res = OLS(y, X).fit()
-
-        # Save
-        betas = dict()
-        betas['beta'] = res.params[0]
-        betas['se'] = res.bse[0]
-        betas['p'] = res.pvalues[0]
-        betas['area'] = area
-        df_betas = df_betas.append(betas, ignore_index=True)
+    # Fit all areas at once
+    Y = df_roi[areas].to_numpy(dtype=float)
+    params, bse, _, p = multiOLS(Y, X.to_numpy())
+    
+    # DF for all betas (first regressor only)
+    buf = ResultBuffer({'beta': float, 'se': float, 'p': float,
+                        'area': object}, len(areas))
+    buf.add(beta=params[0], se=bse[0], p=p[0], area=np.asarray(areas))
+    df_betas = buf.to_frame()
         
     joblog.write('Done.\n')
     
@@ -214,9 +344,6 @@ def fitAudio(df_roi, joblog, dmfile, areas=None,):
 
 # Fit beta series -- CHECKED
 def fitBS(df_roi, joblog, dmfile, areas=None):
-    
-    # DF for all betas
-    df_betas = pd.DataFrame(columns=['area','bound','beta','se','p'])
 
     joblog.write('Fitting GLMs for ' + dmfile + '...\n')
     
@@ -225,28 +352,27 @@ def fitBS(df_roi, joblog, dmfile, areas=None):
     df_dm = pd.read_csv(dmpath, index_col=0)
     
     # Constants from long to wide
-    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run')
+    X = pd.get_dummies(df_dm, columns=['constant'], prefix='run', dtype=float)
     
     # Select boundary regressors
     bound_inds = X.columns.str.isdigit() # bound regressors are numerical
+    bounds = X.columns[bound_inds].values
     
     if areas is None:
         areas = df_roi.columns[:-1]
     
-    # Loop thru areas, gather betas and append to df
-    for area in areas:
-        
-        y = df_roi[area]
-        res = OLS(y, X).fit()
-
-        # Save betas for each bound
-        betas = pd.DataFrame()
-        betas['bound'] = X.columns[bound_inds].values
-        betas['area'] = area
-        betas['beta'] = res.params[bound_inds].to_numpy()
-        betas['se'] = res.bse[bound_inds].to_numpy()
-        betas['p'] = res.pvalues[bound_inds].to_numpy()
-        df_betas = df_betas.append(betas, ignore_index=True)
+    # Fit all areas at once
+    Y = df_roi[areas].to_numpy(dtype=float)
+    params, bse, _, p = multiOLS(Y, X.to_numpy())
+    
+    # DF for all betas (area by area, each bound)
+    buf = ResultBuffer({'area': object, 'bound': object, 'beta': float,
+                        'se': float, 'p': float}, len(areas)*len(bounds))
+    buf.add(area=np.repeat(np.asarray(areas, dtype=object), len(bounds)),
+            bound=np.tile(bounds, len(areas)),
+            beta=params[bound_inds].ravel(order='F'),
+            se=bse[bound_inds].ravel(order='F'), p=p[bound_inds].ravel(order='F'))
+    df_betas = buf.to_frame()
         
     joblog.write('Done.\n')
     
@@ -3,6 +3,13 @@
 """
 EVENT SEGMENTATION
 Get the betas for the main bounds vs perms analysis
+Usage: python getBoundsPerms.py <react_time> [csv|parquet|both] [--resume]
+    csv/parquet/both: betas as per-subject CSVs and/or in one Parquet dataset
+    partitioned by analysis/subj/area (evseg.betastore; in R arrow::open_dataset).
+    --resume: skip subjects whose output was saved in full from unchanged
+    inputs (a .done.json marker with the size & mtime of the DM and ROI files)
+    and areas already checkpointed (evseg.checkpoint). The slurm scripts don't
+    pass it; add it when resubmitting a job that hit the time limit.
 
 @author:  jenni.saaristo@helsinki.fi
 @version: 2021-08-18
@@ -11,23 +18,31 @@ Get the betas for the main bounds vs perms analysis
 
 import os
 from sys import argv
+import sys
 import time
 from joblib import Parallel, delayed
 import pandas as pd
 
-from fitGLMs import fitPerms
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.roidata import load_roi, roi_inputs
+from evseg.betastore import write_output, betastore
+from evseg.checkpoint import (ckpt_dir, open_checkpoints, fit_checkpointed, close_checkpoints,
+                              file_stamps, is_done, mark_done, clear_done)
+
+from fitGLMs import fitPerms, permDesign, dmdir
 
 # Global locations
 rootdir = '/m/nbe/scratch/alex/private/jenni/eventseg'
 savedir = os.path.join(rootdir, 'fmri-data','ini-roi')
-roifile = 'tc_hoahc_concat.csv'
 
 
 # =============================================================================
 # 
 # =============================================================================
 
-def getBoundsPerms(subj,dmfile,permfile,outfile):
+def getBoundsPerms(subj,dmfile,permfile,outfile,outfmt='csv',resume=False):
     
     tic = time.time() # Start
     
@@ -35,21 +50,36 @@ def getBoundsPerms(subj,dmfile,permfile,outfile):
     if not os.path.isdir(savepath):
         os.makedirs(savepath)
 
-    joblog = open(os.path.join(savepath,'perms_log.txt'), 'w')
+    # Done already, from the same inputs?
+    savefile = os.path.join(savepath, outfile)
+    root = os.path.join(savedir, betastore)
+    inputs = [os.path.join(dmdir, f) for f in [dmfile, permfile]] + roi_inputs(savepath)
+    meta = {'dmfile': dmfile, 'permfile': permfile, 'inputs': file_stamps(inputs)}
+    done = dict(meta, outfmt=outfmt)
+    if resume and is_done(savefile, done):
+        return 0
+    clear_done(savefile)
+
+    joblog = open(os.path.join(savepath,'perms_log.txt'), 'a' if resume else 'w')
     joblog.write('Started '+ subj + ': '+ time.asctime(time.localtime(tic)) + '\n')
     joblog.write('PID: '+ str(os.getpid()) + '\n')
     
     try:
         # Get ROI time courses
-        roipath = os.path.join(savepath,roifile)
-        df_roi = pd.read_csv(roipath, index_col=0)
-        joblog.write('Loaded '+ roipath + '\n')
+        df_roi = load_roi(savepath) # binary if available
+        joblog.write('Loaded ROI tcs from '+ savepath + '\n')
         
-        # Fit GLMs
-        df_betas = fitPerms(df_roi, joblog, dmfile, permfile)
+        # Fit GLMs, area blocks checkpointed as they finish
+        ckdir = ckpt_dir(savefile)
+        if open_checkpoints(ckdir, meta, resume):
+            joblog.write('Resuming from '+ ckdir + '\n')
+        design = permDesign(dmfile, permfile) # read & projected once for all chunks
+        df_betas = fit_checkpointed(lambda areas: fitPerms(df_roi, joblog, dmfile, permfile, areas, design),
+                                    df_roi.columns[:-1], ckdir, joblog=joblog)
         
-        savefile = os.path.join(savepath, outfile)
-        df_betas.to_csv(savefile)
+        write_output(df_betas, savefile, outfmt, root=root, subj=subj)
+        mark_done(savefile, done)
+        close_checkpoints(ckdir)
         
         toc = time.time() # End
         joblog.write('Ended: '+ time.asctime(time.localtime(toc)) + '\n')
@@ -68,12 +98,16 @@ def getBoundsPerms(subj,dmfile,permfile,outfile):
 
 if __name__ == '__main__':
     
-    assert len(argv) == 2
-    react_time = argv[1]
+    # --resume: skip finished subjects and areas (e.g. after the time limit)
+    resume = '--resume' in argv
+    args = [a for a in argv if a != '--resume']
+    assert len(args) in (2,3)
+    react_time = args[1]
+    outfmt = args[2] if len(args) == 3 else 'csv' # csv, parquet or both
     
     # Files
     dmfile = f'dm_bounds_{react_time}.csv'
-    permfile = f'dm_perms_{react_time}.csv'
+    permfile = f'dm_perms_{react_time}.npy' # binary, memory-mapped
     outfile = f'betas_boundperm_{react_time}.csv'
     
     # Get subjects
@@ -82,7 +116,7 @@ if __name__ == '__main__':
     
     # Iterate subjects
     print('Starting parallel jobs...')
-    res = Parallel(n_jobs=10) (delayed(getBoundsPerms) (subj,dmfile,permfile,outfile) for subj in subjs)
+    res = Parallel(n_jobs=10) (delayed(getBoundsPerms) (subj,dmfile,permfile,outfile,outfmt,resume) for subj in subjs)
     
     df = pd.DataFrame()
     df['subj'] = subjs
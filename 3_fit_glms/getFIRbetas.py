@@ -3,6 +3,8 @@
 """
 EVENT SEGMENTATION
 Fit FIR GLMs
+Usage: python getFIRbetas.py <react_time> [csv|parquet|both] [--resume]
+    (as in getBoundsPerms)
 
 @author:  jenni.saaristo@helsinki.fi
 @version: 2021-08-18
@@ -11,43 +13,66 @@ Fit FIR GLMs
 
 from sys import argv
 import os
+import sys
 import time
 from joblib import Parallel, delayed
 import pandas as pd
 
-from fitGLMs import fitFIR
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.roidata import load_roi, roi_inputs
+from evseg.betastore import write_output, betastore
+from evseg.checkpoint import (ckpt_dir, open_checkpoints, fit_checkpointed, close_checkpoints,
+                              file_stamps, is_done, mark_done, clear_done)
+
+from fitGLMs import fitFIR, dmdir
 
 # Global locations and files
 rootdir = '/m/nbe/scratch/alex/private/jenni/eventseg'
 savedir = os.path.join(rootdir, 'fmri-data','ini-roi')
-roifile = 'tc_hoahc_concat.csv'
 conds = ['low','mid','high','all']
 
 # =============================================================================
 #
 # =============================================================================
 
-def getFIRbetas(subj,dmprefix,savefile):
+def getFIRbetas(subj,dmprefix,savefile,outfmt='csv',resume=False):
     tic = time.time() # Start
 
     savepath = os.path.join(savedir,subj)
     if not os.path.isdir(savepath):
         os.makedirs(savepath)
 
-    joblog = open(os.path.join(savepath,'fir_log.txt'), 'w')
+    # Done already, from the same inputs?
+    savefile = os.path.join(savepath, savefile)
+    root = os.path.join(savedir, betastore)
+    inputs = [os.path.join(dmdir, f'{dmprefix}_{cond}.csv') for cond in conds] + roi_inputs(savepath)
+    meta = {'dmprefix': dmprefix, 'conds': conds, 'inputs': file_stamps(inputs)}
+    done = dict(meta, outfmt=outfmt)
+    if resume and is_done(savefile, done):
+        return 0
+    clear_done(savefile)
+
+    joblog = open(os.path.join(savepath,'fir_log.txt'), 'a' if resume else 'w')
     joblog.write('Started '+ subj + ': '+ time.asctime(time.localtime(tic)) + '\n')
     joblog.write('PID: '+ str(os.getpid()) + '\n')
 
     try:
         # Get ROI tcs
-        roipath = os.path.join(savepath,roifile)
-        df_roi = pd.read_csv(roipath, index_col=0)
-        joblog.write('Loaded '+ roipath + '\n')
+        df_roi = load_roi(savepath) # binary if available
+        joblog.write('Loaded ROI tcs from '+ savepath + '\n')
 
-        # Fit GLMs for FIR
-        df_betas = fitFIR(df_roi, joblog, dmprefix, conds=conds)
+        # Fit GLMs for FIR, area blocks checkpointed as they finish
+        ckdir = ckpt_dir(savefile)
+        if open_checkpoints(ckdir, meta, resume):
+            joblog.write('Resuming from '+ ckdir + '\n')
+        df_betas = fit_checkpointed(lambda areas: fitFIR(df_roi, joblog, dmprefix, conds, areas),
+                                    df_roi.columns[:-1], ckdir, joblog=joblog)
 
-        df_betas.to_csv(os.path.join(savepath, savefile))
+        write_output(df_betas, savefile, outfmt, root=root, subj=subj)
+        mark_done(savefile, done)
+        close_checkpoints(ckdir)
 
         toc = time.time() # End
         joblog.write('Ended: '+ time.asctime(time.localtime(toc)) + '\n')
@@ -66,8 +91,12 @@ def getFIRbetas(subj,dmprefix,savefile):
 
 if __name__ == '__main__':
     
-    assert len(argv) == 2
-    react_time = argv[1]
+    # --resume: skip finished subjects and areas (e.g. after the time limit)
+    resume = '--resume' in argv
+    args = [a for a in argv if a != '--resume']
+    assert len(args) in (2,3)
+    react_time = args[1]
+    outfmt = args[2] if len(args) == 3 else 'csv' # csv, parquet or both
     
     # Files
     dmprefix = f'dm_fir_{react_time}'
@@ -79,7 +108,7 @@ if __name__ == '__main__':
 
     # Iterate subjects
     print('Starting parallel jobs...')
-    res = Parallel(n_jobs=2) (delayed(getFIRbetas) (subj,dmprefix,savefile) for subj in subjs)
+    res = Parallel(n_jobs=2) (delayed(getFIRbetas) (subj,dmprefix,savefile,outfmt,resume) for subj in subjs)
 
     df = pd.DataFrame()
     df['subj'] = subjs
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EVENT SEGMENTATION
+Voxelwise bounds vs perms, within a mask (hippocampus or whole-brain GM)
+
+The voxel time courses of the mask are streamed out of the runs once into a
+memory-mapped TR x voxel file per subject (kept for reruns), and then fitted
+a chunk of voxels at a time (fitPermsVoxels). Saves the beta, se and
+parametric p of the bounds and the permutation p as NIfTI maps, and the perm
+betas as a voxels x perms binary for group-level averaging.
+
+@notes:   python getVoxelPerms.py 3s hc (or gm) [order scale], cleaning as in getROItcs
+"""
+
+import os
+from sys import argv
+import sys
+import time
+from joblib import Parallel, delayed
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from nilearn import datasets
+
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.roiextract import cached_label_index, extract_voxels, run_index, to_img
+
+from fitGLMs import fitPermsVoxels, loadPerms, dmdir
+
+# Global locations
+rootdir = '/m/nbe/scratch/alex/private/jenni/eventseg'
+savedir = os.path.join(rootdir, 'fmri-data','ini-vox')
+maskdir = os.path.join(rootdir,'masks')
+inidir = '/m/nbe/scratch/alex/private/maria/alex/ini-data'
+nii = '_mni152_maxCorr10_LP4Hz_smoothed6_tsm2.nii'
+runs = list(range(2,12)) # story is in runs 2–11
+block = 50   # volumes read at a time
+# voxels fitted at a time, sets the memory: the float64 copies of each time
+# course made by clean_tcs and the residualization come to ~ 6 x 8 B x TRs,
+# ~140 kB per voxel at 3000 TRs, so ~300 MB per worker at 2000, plus ~50 MB
+# for the residualized bounds/perms (within the 700 MB/CPU of slurm_getvoxperm.sh)
+chunk = 2000
+
+def iniFiles(subj):
+    return [os.path.join(inidir, subj, 'run'+str(run), 'acc' + str(run) + nii)
+            for run in runs]
+
+
+# =============================================================================
+#
+# =============================================================================
+
+def getVoxelPerms(subj,maskimg,maskname,dmfile,permfile,outprefix,order=1,scale='zscore'):
+
+    tic = time.time() # Start
+
+    savepath = os.path.join(savedir,subj)
+    if not os.path.isdir(savepath):
+        os.makedirs(savepath)
+
+    joblog = open(os.path.join(savepath,f'voxperms_{maskname}_log.txt'), 'w')
+    joblog.write('Started '+ subj + ': '+ time.asctime(time.localtime(tic)) + '\n')
+    joblog.write('PID: '+ str(os.getpid()) + '\n')
+
+    try:
+        inifiles = iniFiles(subj)
+        target = nib.load(inifiles[0])
+        vox, _, _ = cached_label_index([maskimg], target, maskdir)
+        runind = run_index(inifiles)
+
+        # Voxel time courses (raw), extracted only once
+        tcfile = os.path.join(savepath, f'tc_{maskname}_vox.npy')
+        if not os.path.isfile(tcfile):
+            joblog.write(f'Extracting {len(vox)} voxels...\n')
+            tmp = tcfile[:-4] + '_tmp.npy'
+            tcs = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                            shape=(len(runind), len(vox)))
+            extract_voxels(inifiles, vox, tcs, block=block)
+            tcs.flush()
+            del tcs
+            os.replace(tmp, tcfile)
+        tcs = np.load(tcfile, mmap_mode='r')
+        joblog.write('Loaded voxel tcs from '+ tcfile + '\n')
+
+        # Fit GLMs, perm betas straight into a memory map
+        _, permcols = loadPerms(os.path.join(dmdir, permfile))
+        permbetas = np.lib.format.open_memmap(os.path.join(savepath, outprefix+'_permbetas.npy'),
+                                              mode='w+', dtype=np.float32,
+                                              shape=(len(vox), len(permcols)))
+        joblog.write(f'Cleaning: detrend order {order}, scaling {scale}\n')
+        res = fitPermsVoxels(tcs, runind, joblog, dmfile, permfile, chunk=chunk,
+                             order=order, scale=scale, perm_betas=permbetas)
+        permbetas.flush()
+
+        # Maps
+        for k in ['beta','se','p','permp']:
+            fill = 1. if k in ('p','permp') else 0.
+            to_img(res[k], vox, target, fill).to_filename(
+                os.path.join(savepath, f'{outprefix}_{k}.nii.gz'))
+
+        toc = time.time() # End
+        joblog.write('Ended: '+ time.asctime(time.localtime(toc)) + '\n')
+        joblog.close()
+
+    except Exception as e:
+        toc = time.time() # End
+        joblog.write('Error occured:' + time.asctime(time.localtime(toc)) + '\n')
+        print(e, file=joblog)
+        joblog.close()
+        return 1
+
+    return 0
+
+# ---------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    assert len(argv) in (3,5)
+    react_time = argv[1]
+    maskname = argv[2] # hc (makeHCmask) or gm (MNI152 grey matter)
+    order = int(argv[3]) if len(argv) == 5 else 1 # detrend order (-1 for none)
+    scale = argv[4] if len(argv) == 5 else 'zscore' # zscore, psc or none
+    order = None if order < 0 else order
+    scale = None if scale == 'none' else scale
+
+    # Files
+    dmfile = f'dm_bounds_{react_time}.csv'
+    permfile = f'dm_perms_{react_time}.npy' # binary, memory-mapped
+    outprefix = f'voxperm_{maskname}_{react_time}'
+
+    # Mask
+    if maskname == 'hc':
+        maskimg = os.path.join(maskdir,'hipp_thr25_2mm.nii')
+    elif maskname == 'gm':
+        maskimg = datasets.load_mni152_gm_mask(resolution=2)
+    else:
+        raise ValueError(f'Unknown mask {maskname}, use hc or gm.')
+
+    # Get subjects
+    df_subj = pd.read_csv(os.path.join(rootdir,'scripts','subj_info.csv'))
+    subjs = df_subj.subj
+
+    # Voxel index of the mask, before the jobs start
+    cached_label_index([maskimg], nib.load(iniFiles(subjs[0])[0]), maskdir)
+
+    # Iterate subjects
+    print('Starting parallel jobs...')
+    res = Parallel(n_jobs=10) (delayed(getVoxelPerms) (subj,maskimg,maskname,dmfile,permfile,outprefix,order,scale) for subj in subjs)
+
+    df = pd.DataFrame()
+    df['subj'] = subjs
+    df['fail'] = res
+
+    print(df)
+    print('All done.')
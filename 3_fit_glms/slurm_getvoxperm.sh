@@ -0,0 +1,12 @@
+#!/bin/bash
+#SBATCH --job-name=getVoxelPerms
+#SBATCH --cpus-per-task=10
+#SBATCH --output=/m/nbe/scratch/alex/private/jenni/eventseg/scripts/logs/job_%j.out
+#SBATCH --time=04:00:00
+#SBATCH --mem-per-cpu=700
+
+# Job step
+module load anaconda
+source activate /m/nbe/scratch/alex/private/jenni/eventseg/evseg_env
+
+srun python3 getVoxelPerms.py 3s hc
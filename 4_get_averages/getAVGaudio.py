@@ -3,6 +3,9 @@
 """
 EVENT SEGMENTATION
 Gather betas and calc basic average
+Usage: python getAVGaudio.py <react_time> [csv|parquet|both] [csv|parquet]
+    Output format (as in getBoundsPerms), then where to read the subject
+    betas from (default csv).
 
 @author:  jenni.saaristo@helsinki.fi
 @version: 2021-08-26
@@ -12,9 +15,14 @@ Gather betas and calc basic average
 from sys import argv
 import os
 import time
-from joblib import Parallel, delayed
+import sys
 import pandas as pd
-from math import sqrt
+
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.aggregate import average_subjects
+from evseg.betastore import write_output, subject_reader, analysis_name, betastore
 
 # Global locations
 rootdir = '/m/nbe/scratch/alex/private/jenni/eventseg'
@@ -23,7 +31,7 @@ outdir = os.path.join(rootdir, 'scripts/4_get_averages/out')
 
 subsets = {'all': ''}
 
-def getAVGperms(key, subjs, betafile,avgfile,longfile):
+def getAVGaudio(subjsets, betafile,avgfile,longfile,outfmt='csv',infmt='csv'):
 
     tic = time.time() # Start
     pid = str(os.getpid())
@@ -32,13 +40,16 @@ def getAVGperms(key, subjs, betafile,avgfile,longfile):
     joblog.write(f'PID: {str(os.getpid())}\n')
 
     try:
-        #  ------------ Get subject files ----------
-        df_all = pd.DataFrame()
+        #  ------ Read subject files once, AVG all subsets at the same time ------
+        # (from the subject CSVs or the Parquet store)
+        if infmt == 'csv':
+            files, read = {s: os.path.join(dataroot, s, betafile) for s in subjsets['all']}, None
+        else:
+            files = {s: s for s in subjsets['all']}
+            read = subject_reader(os.path.join(dataroot, betastore), analysis_name(betafile))
         try:
-            for s in subjs:
-                df_this = pd.read_csv(os.path.join(dataroot, s, betafile),index_col=0)
-                df_this['subj'] = s
-                df_all = df_all.append(df_this, ignore_index=True)
+            avgs, df_long = average_subjects(files, ['area','perm'], subjsets,
+                                             keep='perm == 0', read=read)
         except FileNotFoundError as e:
             toc = time.time() # End
             joblog.write('Missing file! \n')
@@ -48,32 +59,15 @@ def getAVGperms(key, subjs, betafile,avgfile,longfile):
             return 1
 
         # Save longfile (only for all subjects and only for intact bounds)
-        if key == 'all':
-            df_all.query('perm == 0').to_csv(os.path.join(outdir, longfile))
-
-        #  ---------------- Calc AVG --------------
-        df_avg = pd.DataFrame()
-        areas = df_all.area.unique()
-        perms = df_all.perm.unique()
-
-        # do areas
-        for a in areas:
-            # do perms
-            for p in perms:
-                these = df_all.query('perm == @p & area == @a & subj in @subjs')
-                avg = these['beta'].mean()
-                se = these['beta'].std()/sqrt(len(these)) # SEM
-                this = {'perm': p,
-                        'beta': avg,
-                        'se': se,
-                        'area': a}
-                df_avg = df_avg.append(this, ignore_index=True)
-
-        savefile = f'{avgfile}_{key}.csv'
-        df_avg.to_csv(os.path.join(outdir, savefile))
+        write_output(df_long, os.path.join(outdir, longfile), outfmt)
+
+        #  ---------------- Save AVGs --------------
+        for (key, df_avg) in avgs.items():
+            savefile = f'{avgfile}_{key}.csv'
+            write_output(df_avg[['perm','beta','se','area']], os.path.join(outdir, savefile), outfmt)
+            joblog.write('Saved: '+ savefile + '\n')
 
         toc = time.time() # End
-        joblog.write('Saved: '+ savefile + '\n')
         joblog.write('Ended: '+ time.asctime(time.localtime(toc)) + '\n')
         joblog.close()
 
@@ -90,8 +84,11 @@ def getAVGperms(key, subjs, betafile,avgfile,longfile):
 
 if __name__ == '__main__':
     
-    assert len(argv) == 2
+    assert len(argv) in (2,3,4)
     react_time = argv[1]
+    outfmt = argv[2] if len(argv) >= 3 else 'csv' # csv, parquet or both
+    infmt = argv[3] if len(argv) == 4 else 'csv'  # betas from csv or parquet
+    assert infmt in ('csv','parquet')
     
     # Files
     betafile = f'betas_audioperm_{react_time}.csv'
@@ -112,14 +109,11 @@ if __name__ == '__main__':
             print(key + ', nsubj: '+ str(subjsets[key].count()))
 
 
-    # Iterate subject sets (3)
-    print('Starting parallel jobs...')
-    res = Parallel(n_jobs=1) (delayed(getAVGperms) (key,subjs,betafile,avgfile,longfile) for (key,subjs) in subjsets.items())
-
-    df = pd.DataFrame()
-    df['subj'] = list(subsets.keys())
-    df['fail'] = res
+    # All subject sets in one pass
+    print('Reading subjects...')
+    res = getAVGaudio(subjsets,betafile,avgfile,longfile,outfmt,infmt)
 
-    print(df)
+    # one status for all subject sets (they are averaged together)
+    print(f'Subject sets {", ".join(subsets)}: ' + ('failed, see the job log.' if res else 'ok.'))
 
     print('All done.')
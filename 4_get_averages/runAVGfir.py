@@ -3,6 +3,9 @@
 """
 EVENT SEGMENTATION
 Gather betas and calc basic average for FIR models
+Usage: python runAVGfir.py <react_time> [csv|parquet|both] [csv|parquet]
+    Output format (as in getBoundsPerms), then where to read the subject
+    betas from (default csv).
 
 @author:  jenni.saaristo@helsinki.fi
 @version: 2021-08-18
@@ -11,8 +14,14 @@ Gather betas and calc basic average for FIR models
 
 from sys import argv
 import os
+import sys
 import pandas as pd
-from math import sqrt
+
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.aggregate import average_subjects
+from evseg.betastore import write_output, subject_reader, analysis_name, betastore
 
 dataroot = '/m/nbe/scratch/alex/private/jenni/eventseg/fmri-data/ini-roi'
 scriptroot = '/m/nbe/scratch/alex/private/jenni/eventseg/scripts'
@@ -22,64 +31,53 @@ subsets = {'all': '',
 
 outdir = os.path.join(scriptroot,'4_get_averages/out')
 
-def runAVGfir(betafile,longfile,savepfix):
+def runAVGfir(betafile,longfile,savepfix,outfmt='csv',infmt='csv'):
     
     # Get subjs
     df_subj = pd.read_csv(os.path.join(scriptroot, 'subj_info.csv'))
     
-    # Get data
-    df_all = pd.DataFrame()
-    for s in df_subj.subj:
-        df_this = pd.read_csv(os.path.join(dataroot, s, betafile),index_col=0)
-        df_this['subj'] = s
-        df_all = df_all.append(df_this, ignore_index=True)
-    
-    # Save long df
-    df_all.to_csv(os.path.join(outdir, longfile))
-    print('Saved longfile. Calculating averages...')
-    
-    # Calc and save
-    areas = df_all.area.unique()
-    regs = df_all.regressor.unique()
-    conds = df_all.cond.unique()
-    
+    # Subject sets
+    subjsets = dict()
     for (key, expr) in subsets.items():
-    
         if key == 'all':
-            subjs = df_subj.subj
+            subjsets[key] = df_subj.subj
         else:
-            subjs = df_subj.query(subsets[key]).subj
-        print(f'{key}, nsubj: {str(subjs.count())}')
+            subjsets[key] = df_subj.query(subsets[key]).subj
+        print(f'{key}, nsubj: {str(subjsets[key].count())}')
+    
+    # Get data and calc all averages in one pass
+    # (from the subject CSVs or the Parquet store)
+    if infmt == 'csv':
+        files, read = {s: os.path.join(dataroot, s, betafile) for s in df_subj.subj}, None
+    else:
+        files = {s: s for s in df_subj.subj}
+        read = subject_reader(os.path.join(dataroot, betastore), analysis_name(betafile))
+    avgs, df_all = average_subjects(files, ['area','cond','regressor'], subjsets,
+                                    keep=True, read=read)
+    
+    # Save long df
+    write_output(df_all, os.path.join(outdir, longfile), outfmt)
+    print('Saved longfile.')
     
-        df_avg = pd.DataFrame()
-        # do areas
-        for a in areas:
-            # do levels
-            for c in conds:
-                # do delays
-                for r in regs:
-                    these = df_all.query('regressor == @r & cond == @c & area == @a & subj in @subjs')
-                    avg = these['beta'].mean()
-                    se = these['beta'].std()/sqrt(len(these))
-                    this = {'regressor': r,
-                            'beta': avg,
-                            'se': se,
-                            'cond': c,
-                            'area': a}
-                    df_avg = df_avg.append(this, ignore_index=True)
+    # Save averages
+    for (key, df_avg) in avgs.items():
         savefile = f'{savepfix}_{key}.csv'
-        df_avg.to_csv(os.path.join(outdir, savefile))
+        write_output(df_avg[['regressor','beta','se','cond','area']],
+                     os.path.join(outdir, savefile), outfmt)
         print('Saved '+ savefile)
     
     print('Done.')
 
 if __name__ == '__main__':
     
-    assert len(argv) == 2
+    assert len(argv) in (2,3,4)
     react_time = argv[1]
+    outfmt = argv[2] if len(argv) >= 3 else 'csv' # csv, parquet or both
+    infmt = argv[3] if len(argv) == 4 else 'csv'  # betas from csv or parquet
+    assert infmt in ('csv','parquet')
     
     betafile = f'betas_fir_{react_time}.csv'
     longfile = f'betas_fir_long_{react_time}.csv'
     savepfix = f'AVG_fir_{react_time}'
     
-    runAVGfir(betafile,longfile,savepfix)
+    runAVGfir(betafile,longfile,savepfix,outfmt,infmt)
@@ -4,6 +4,9 @@
 EVENT SEGMENTATION
 Gather betas for beta series
 NOTE: for the linear model we don't need averages, so we just save the longfile
+Usage: python runAVGseries.py <react_time> [csv|parquet|both] [csv|parquet]
+    Output format (as in getBoundsPerms), then where to read the subject
+    betas from (default csv).
 
 @author:  jenni.saaristo@helsinki.fi
 @version: 2021-08-18
@@ -12,34 +15,51 @@ NOTE: for the linear model we don't need averages, so we just save the longfile
 
 from sys import argv
 import os
+import sys
 import pandas as pd
 
+# evseg lives with the boundary scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '1_create_boundaries'))
+from evseg.results import ResultBuffer
+from evseg.betastore import write_output, subject_reader, analysis_name, betastore
+
 dataroot = '/m/nbe/scratch/alex/private/jenni/eventseg/fmri-data/ini-roi'
 scriptroot = '/m/nbe/scratch/alex/private/jenni/eventseg/scripts'
 outdir = os.path.join(scriptroot, '4_get_averages/out')
 
-def runAVGseries(betafile,longfile):
+def runAVGseries(betafile,longfile,outfmt='csv',infmt='csv'):
     # Get subjs
     df_subj = pd.read_csv(os.path.join(scriptroot, 'subj_info.csv'))
 
-    # Get data
-    df_all = pd.DataFrame()
+    # Get data (from the subject CSVs or the Parquet store)
+    if infmt == 'parquet':
+        read = subject_reader(os.path.join(dataroot, betastore), analysis_name(betafile))
+    buf = None
     for s in df_subj.subj:
-        df_this = pd.read_csv(os.path.join(dataroot, s, betafile),index_col=0)
-        df_this['subj'] = s
-        df_all = df_all.append(df_this, ignore_index=True)
+        if infmt == 'csv':
+            df_this = pd.read_csv(os.path.join(dataroot, s, betafile),index_col=0)
+        else:
+            df_this = read(s)
+        if buf is None:
+            buf = ResultBuffer.like(df_this, len(df_this)*len(df_subj), subj=object)
+        buf.add_frame(df_this, subj=s)
+    df_all = buf.to_frame()
 
     # Save long df
-    df_all.to_csv(os.path.join(outdir, longfile))
+    write_output(df_all, os.path.join(outdir, longfile), outfmt)
     print('Saved longfile. Done.')
 
 
 if __name__ == '__main__':
 
-    assert len(argv) == 2
+    assert len(argv) in (2,3,4)
     react_time = argv[1]
+    outfmt = argv[2] if len(argv) >= 3 else 'csv' # csv, parquet or both
+    infmt = argv[3] if len(argv) == 4 else 'csv'  # betas from csv or parquet
+    assert infmt in ('csv','parquet')
 
     betafile = f'betas_series_{react_time}.csv'
     longfile = f'betas_series_long_{react_time}.csv'
 
-    runAVGseries(betafile,longfile)
+    runAVGseries(betafile,longfile,outfmt,infmt)
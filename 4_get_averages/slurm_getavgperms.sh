@@ -1,6 +1,6 @@
 #!/bin/bash
 #SBATCH --job-name=getAVGperms
-#SBATCH --cpus-per-task=3
+#SBATCH --cpus-per-task=1
 #SBATCH --output=/m/nbe/scratch/alex/private/jenni/eventseg/scripts/logs/job_%j.out
 #SBATCH --time=01:30:00
 #SBATCH --mem-per-cpu=500M
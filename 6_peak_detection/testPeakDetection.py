@@ -6,6 +6,7 @@ Created on Tue Nov 30 11:10:51 2021
 @author: jenska
 """
 import os
+import sys
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -14,8 +15,14 @@ dataroot = '/Users/jenska/code/python/eventcode'
 indir = os.path.join(dataroot,'1_create_boundaries/out')
 boundfile = 'boundaries_f3s.csv'
 permfile = 'perms_f3s.npy'
+avgfile = '/m/nbe/scratch/alex/private/jenni/eventseg/fmri-data/ini-roi/tc_hoahc_concat_avg.csv'
 
-# average signal across participants (save and load)
+sys.path.append(os.path.join(dataroot,'6_peak_detection'))
+from peakDetect import forwardSelect, matchTriggers
+
+# average signal across participants (from avgROItcs)
+df_avg = pd.read_csv(avgfile, index_col=0)
+area = df_avg.columns[48] # HC
 
 # Get boundaries and parts
 df_bounds = pd.read_csv(os.path.join(indir,boundfile),index_col=0)
@@ -30,76 +37,49 @@ Niter = len(df_bounds)
 NTR = df_parts.flen.sum()
 
 
-#%% Randomly select some TRs
-
-TRpool = np.ones(NTR)
-for i in range(Niter):
-    
-    # get available TRs
-    inds = np.nonzero(TRpool)[0]
-    #print(len(inds))
-    
-    # for each TR:
-        # create DM with trigger at this TR
-        # fit to data
-        # collect RSS of model
-    # select TR with lowest RSS (beta>0, no-flip)
-    
-    selTR = np.random.choice(inds)
-    
-    # add TR to model and remove from pool
-    TRpool[selTR] = 0
+#%% Select the trigger TRs
+# Greedy forward selection: on each iteration add the TR whose trigger
+# (stick * HRF) gives the lowest RSS, with beta > 0 and no earlier beta
+# flipping negative. All candidates are evaluated at once, see peakDetect.
+
+df_sel = forwardSelect(df_avg[area].to_numpy(), df_avg['runind'].to_numpy(), Niter)
+print(df_sel)
+print(f'Selected {len(df_sel)} of {Niter} triggers')
 
 # Define trigger model
-model = np.nonzero(TRpool == 0)[0]
+model = np.sort(df_sel['tr'].to_numpy())
 print(model)
 # Save the model
+df_sel.to_csv(os.path.join(dataroot,'6_peak_detection',f'peaks_{area}.csv'))
 
-del(inds,selTR)
 #%% Test fit
 
 # get perms
 perms = np.load(os.path.join(indir, permfile))
-matches = np.zeros((Niter,1001))
-
-# Test model fit with permutations (± 2 sec)
-win = 2
-for i_perm in range(perms.shape[1]):
-    perm = perms[:,i_perm]
-    
-    # Compare each trigger in the model to this perm
-    for i_trig in range(len(model)):
-        trigger = model[i_trig]
-        diff = perm - trigger
-        # if there's a close enough match, mark the trigger as matched
-        if len(np.nonzero(abs(diff) < win)[0]):
-            matches[i_trig,i_perm] = 1
-
-# Finally do the same for intact boundaries
-i_perm = matches.shape[1]-1   # use the last column
-perm = df_bounds.frt_concat.to_numpy()
-for i_trig in range(len(model)):
-        trigger = model[i_trig]
-        diff = perm - trigger
-        # if there's a close enough match, mark the trigger as matched
-        if len(np.nonzero(abs(diff) < win)[0]):
-            matches[i_trig,i_perm] = 1
-
-# Get match proportions for all
-match_prop = matches.sum(axis=0)/matches.shape[0]
+bounds = df_bounds.frt_concat.to_numpy()
+
+# Test model fit with permutations and the intact boundaries (the last
+# column), all triggers x sets x windows at once
+wins = [1, 2, 3, 4]
+matches = np.concatenate([matchTriggers(model, perms, wins),
+                          matchTriggers(model, bounds[:,np.newaxis], wins)], axis=1)
+
+# Get match proportions for all (sets x windows)
+match_prop = matches.mean(axis=0)
 # Save these results
+df_match = pd.DataFrame(match_prop, columns=[f'win{w}' for w in wins])
+df_match['set'] = [f'perm{i}' for i in range(perms.shape[1])] + ['bounds']
+df_match.to_csv(os.path.join(dataroot,'6_peak_detection',f'peakmatches_{area}.csv'))
 
-# Calc significance as proportion of perms > bounds
+# Calc significance as proportion of perms > bounds, per window
 match_bounds = match_prop[-1]
-perm_inds = np.nonzero( match_prop[:-1] >  match_bounds)[0]
-sig = len(perm_inds) / (len(match_prop)-1)
+sig = (match_prop[:-1] > match_bounds).mean(axis=0)
 
-print(sig)
-print(match_prop.mean())
-print(match_bounds)
-plt.hist(match_prop)
+for (j,w) in enumerate(wins):
+    print(f'win {w}: sig {sig[j]}, perms {match_prop[:-1,j].mean()}, bounds {match_bounds[j]}')
+plt.hist(match_prop[:-1, wins.index(2)])
+plt.axvline(match_bounds[wins.index(2)], c='r')
 
-# With randomly selected TRs this should not be significant, and it isn't
+# (With randomly selected TRs this was not significant, as it shouldn't be)
 
-del(perm,trigger,diff,i_trig,i_perm)
 #%%
\ No newline at end of file